@@ -1,13 +1,20 @@
 import datetime
+import time
 import uuid
 from fastapi import HTTPException
+from sqlalchemy import any_, bindparam
+from sqlalchemy.dialects.postgresql import ARRAY, UUID
 from sqlalchemy.exc import SQLAlchemyError
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.future import select
 
 from .models import Wallet, Operation
+from .retry import RETRY_STATS, get_busy_reason, run_with_retry, set_write_timeouts
+from .sharding import group_by_shard, shard_bind
+from .wallet_filter import WALLET_FILTER
 from ..schemas.operation import OperationRequest, OperationType
-from ..schemas.wallet import WalletBalanceResponse
+from ..schemas.transfer import TransferRequest
+from ..schemas.wallet import LOOKUP_MAX_BATCH_SIZE, WalletBalanceResponse
 
 
 async def get_wallet_by_uuid(wallet_uuid: uuid.UUID, db: AsyncSession, for_update: bool = False) -> Wallet:
@@ -30,23 +37,73 @@ async def get_wallet_by_uuid(wallet_uuid: uuid.UUID, db: AsyncSession, for_updat
     try:
         stmt = select(Wallet).filter(Wallet.wallet_uuid == wallet_uuid)
 
-        if for_update:
-            stmt = stmt.with_for_update()
-
-        result = await db.execute(stmt)
-        wallet = result.scalar_one_or_none()
-        return wallet
-
-    except SQLAlchemyError:
+        # Запрос выполняется на шарде кошелька
+        bind_arguments = shard_bind(db, wallet_uuid)
+
+        if not for_update:
+            result = await db.execute(stmt, bind_arguments=bind_arguments)
+            return result.scalar_one_or_none()
+
+        # Замеряем время ожидания блокировки строки
+        started = time.perf_counter()
+        try:
+            result = await db.execute(stmt.with_for_update(), bind_arguments=bind_arguments)
+        finally:
+            RETRY_STATS.record_lock_wait(time.perf_counter() - started)
+        return result.scalar_one_or_none()
+
+    except SQLAlchemyError as e:
+        # Таймауты и дедлоки пробрасываются дальше для повтора транзакции или ответа 503
+        if get_busy_reason(e):
+            raise
         raise HTTPException(status_code=500, detail="Database error during wallet retrieval")
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Unexpected error: {str(e)}")
 
 
+async def _apply_wallet_operation(wallet_uuid: uuid.UUID, operation: OperationRequest, db: AsyncSession,
+                                  remaining_ms: int | None = None):
+    """
+    Одна попытка транзакции операции над кошельком: блокировка строки, изменение баланса и коммит.
+    """
+    await set_write_timeouts(db, wallet_uuid, remaining_ms)
+    wallet = await get_wallet_by_uuid(wallet_uuid, db, for_update=True)
+    if wallet is None:
+        return None
+
+    if operation.operation_type == OperationType.DEPOSIT:
+        wallet.balance += operation.amount
+    elif operation.operation_type == OperationType.WITHDRAW:
+        if wallet.balance < operation.amount:
+            raise HTTPException(status_code=400, detail="Insufficient funds")
+        wallet.balance -= operation.amount
+
+    # Создаем объект операции и сохраняем в базу данных
+    new_operation = Operation(
+        wallet_uuid=wallet_uuid,
+        operation_type=operation.operation_type,
+        amount=operation.amount,
+        timestamp=datetime.datetime.utcnow()  # Добавление времени операции
+    )
+    db.add(new_operation)
+    await db.commit()
+    await db.refresh(wallet)
+
+    return {
+        "wallet_uuid": wallet_uuid,
+        "operation_type": operation.operation_type,
+        "amount": operation.amount,
+        "new_balance": str(wallet.balance)
+    }
+
+
 async def create_wallet_operation(wallet_uuid: uuid.UUID, operation: OperationRequest, db: AsyncSession):
     """
     Выполняет операцию пополнения или снятия средств с кошелька.
 
+    Транзакция выполняется с lock_timeout и statement_timeout и повторяется с джиттером
+    при таймауте блокировки, дедлоке или ошибке сериализации (см. `run_with_retry`).
+
     Args:
         wallet_uuid (uuid.UUID): UUID кошелька
         operation (OperationRequest): Данные операции (тип и сумма)
@@ -56,41 +113,23 @@ async def create_wallet_operation(wallet_uuid: uuid.UUID, operation: OperationRe
         dict: Информацию о выполненной операции, включая UUID кошелька, тип операции, сумму и новый баланс
 
     Exceptions:
-        HTTPException: В случае ошибки при операциях (недостаточно средств или ошибка базы данных)
+        HTTPException: В случае ошибки при операциях (недостаточно средств, кошелек занят или ошибка базы данных)
         ValueError: В случае недопустимого значения суммы операции
         SQLAlchemyError: В случае ошибки базы данных
         Exception: В случае неожиданной ошибки
     """
-    try:
-        wallet = await get_wallet_by_uuid(wallet_uuid, db, for_update=True)
-        if wallet is None:
-            return None
+    # Несуществующий кошелек отсекается фильтром до открытия транзакции
+    if not WALLET_FILTER.might_contain(wallet_uuid):
+        return None
 
-        if operation.operation_type == OperationType.DEPOSIT:
-            wallet.balance += operation.amount
-        elif operation.operation_type == OperationType.WITHDRAW:
-            if wallet.balance < operation.amount:
-                raise HTTPException(status_code=400, detail="Insufficient funds")
-            wallet.balance -= operation.amount
-
-        # Создаем объект операции и сохраняем в базу данных
-        new_operation = Operation(
-            wallet_uuid=wallet_uuid,
-            operation_type=operation.operation_type,
-            amount=operation.amount,
-            timestamp=datetime.datetime.utcnow()  # Добавление времени операции
+    try:
+        return await run_with_retry(
+            db, lambda remaining_ms: _apply_wallet_operation(wallet_uuid, operation, db, remaining_ms)
         )
-        db.add(new_operation)
-        await db.commit()
-        await db.refresh(wallet)
-
-        return {
-            "wallet_uuid": wallet_uuid,
-            "operation_type": operation.operation_type,
-            "amount": operation.amount,
-            "new_balance": str(wallet.balance)
-        }
 
+    except HTTPException:
+        await db.rollback()
+        raise
     except SQLAlchemyError:
         await db.rollback()
         raise HTTPException(status_code=500, detail="Database error during wallet operation")
@@ -102,6 +141,117 @@ async def create_wallet_operation(wallet_uuid: uuid.UUID, operation: OperationRe
         raise HTTPException(status_code=500, detail=f"Unexpected error: {str(e)}")
 
 
+async def _lock_transfer_wallets(transfer: TransferRequest, db: AsyncSession) -> dict:
+    """
+    Блокирует оба кошелька перевода одним запросом в порядке возрастания UUID.
+
+    Блокировки строк берутся в порядке ORDER BY, поэтому встречные переводы между одной парой кошельков
+    ждут друг друга, а не попадают в дедлок.
+
+    Returns:
+        dict: Заблокированные кошельки по UUID
+
+    Exceptions:
+        HTTPException: В случае, если один из кошельков не найден
+    """
+    stmt = (
+        select(Wallet)
+        .where(Wallet.wallet_uuid.in_([transfer.from_wallet_uuid, transfer.to_wallet_uuid]))
+        .order_by(Wallet.wallet_uuid)
+        .with_for_update()
+    )
+    started = time.perf_counter()
+    try:
+        result = await db.execute(stmt, bind_arguments=shard_bind(db, transfer.from_wallet_uuid))
+    finally:
+        RETRY_STATS.record_lock_wait(time.perf_counter() - started)
+    wallets = {wallet.wallet_uuid: wallet for wallet in result.scalars()}
+
+    for wallet_uuid in (transfer.from_wallet_uuid, transfer.to_wallet_uuid):
+        if wallet_uuid not in wallets:
+            raise HTTPException(status_code=404, detail=f"Wallet {wallet_uuid} not found")
+    return wallets
+
+
+async def _apply_transfer(transfer: TransferRequest, transfer_id: uuid.UUID, db: AsyncSession,
+                          remaining_ms: int | None = None) -> dict:
+    """
+    Одна попытка транзакции перевода: блокировка обоих кошельков, изменение балансов, две записи журнала и коммит.
+    """
+    await set_write_timeouts(db, transfer.from_wallet_uuid, remaining_ms)
+    wallets = await _lock_transfer_wallets(transfer, db)
+    source, destination = wallets[transfer.from_wallet_uuid], wallets[transfer.to_wallet_uuid]
+
+    if source.balance < transfer.amount:
+        raise HTTPException(status_code=400, detail="Insufficient funds")
+    source.balance -= transfer.amount
+    destination.balance += transfer.amount
+
+    # Списание и зачисление связаны общим transfer_id
+    timestamp = datetime.datetime.utcnow()
+    db.add_all([
+        Operation(wallet_uuid=transfer.from_wallet_uuid, operation_type=OperationType.WITHDRAW,
+                  amount=transfer.amount, timestamp=timestamp, transfer_id=transfer_id),
+        Operation(wallet_uuid=transfer.to_wallet_uuid, operation_type=OperationType.DEPOSIT,
+                  amount=transfer.amount, timestamp=timestamp, transfer_id=transfer_id),
+    ])
+    await db.commit()
+
+    return {
+        "transfer_id": transfer_id,
+        "from_wallet_uuid": transfer.from_wallet_uuid,
+        "to_wallet_uuid": transfer.to_wallet_uuid,
+        "amount": transfer.amount,
+        "from_balance": str(source.balance),
+        "to_balance": str(destination.balance)
+    }
+
+
+async def create_transfer(transfer: TransferRequest, db: AsyncSession) -> dict:
+    """
+    Переводит средства с одного кошелька на другой в одной транзакции.
+
+    Оба кошелька блокируются в порядке UUID, списание и зачисление записываются в журнал операций
+    с общим transfer_id и фиксируются одним коммитом. Транзакция выполняется с lock_timeout и statement_timeout
+    и повторяется с джиттером при таймауте блокировки, дедлоке или ошибке сериализации (см. `run_with_retry`).
+    При шардировании оба кошелька должны находиться на одном шарде.
+
+    Args:
+        transfer (TransferRequest): Данные перевода (кошельки и сумма)
+        db (AsyncSession): Асинхронная сессия SQLAlchemy для работы с базой данных
+
+    Returns:
+        dict: Информацию о переводе, включая transfer_id и новые балансы обоих кошельков
+
+    Exceptions:
+        HTTPException: В случае ошибки перевода (кошелек не найден, недостаточно средств, кошельки на разных шардах,
+            кошелек занят или ошибка базы данных)
+        SQLAlchemyError: В случае ошибки базы данных
+        Exception: В случае неожиданной ошибки
+    """
+    for wallet_uuid in (transfer.from_wallet_uuid, transfer.to_wallet_uuid):
+        if not WALLET_FILTER.might_contain(wallet_uuid):
+            raise HTTPException(status_code=404, detail=f"Wallet {wallet_uuid} not found")
+
+    # Транзакция не может охватывать несколько баз данных
+    if shard_bind(db, transfer.from_wallet_uuid) != shard_bind(db, transfer.to_wallet_uuid):
+        raise HTTPException(status_code=400, detail="Transfers between wallets on different shards are not supported")
+
+    transfer_id = uuid.uuid4()
+    try:
+        return await run_with_retry(db, lambda remaining_ms: _apply_transfer(transfer, transfer_id, db, remaining_ms))
+
+    except HTTPException:
+        await db.rollback()
+        raise
+    except SQLAlchemyError:
+        await db.rollback()
+        raise HTTPException(status_code=500, detail="Database error during transfer")
+    except Exception as e:
+        await db.rollback()
+        raise HTTPException(status_code=500, detail=f"Unexpected error: {str(e)}")
+
+
 async def get_wallet_balance(wallet_uuid: uuid.UUID, db: AsyncSession) -> WalletBalanceResponse | None:
     """
     Получает баланс кошелька по UUID.
@@ -118,6 +268,9 @@ async def get_wallet_balance(wallet_uuid: uuid.UUID, db: AsyncSession) -> Wallet
         SQLAlchemyError: В случае ошибки базы данных
         Exception: В случае неожиданной ошибки
     """
+    if not WALLET_FILTER.might_contain(wallet_uuid):
+        return None
+
     try:
         wallet = await get_wallet_by_uuid(wallet_uuid, db)
         if wallet is None:
@@ -128,6 +281,61 @@ async def get_wallet_balance(wallet_uuid: uuid.UUID, db: AsyncSession) -> Wallet
         raise HTTPException(status_code=500, detail=f"Unexpected error: {str(e)}")
 
 
+async def get_wallets_balances(wallet_uuids: list[uuid.UUID], db: AsyncSession) -> tuple[list, list]:
+    """
+    Получает балансы нескольких кошельков одним запросом.
+
+    Все UUID шарда передаются одним массивом в условие `wallet_uuid = ANY(:uuids)`,
+    поэтому запрос использует индекс первичного ключа и выполняется за одно обращение к каждому шарду.
+
+    Args:
+        wallet_uuids (list[uuid.UUID]): Список UUID кошельков (повторы игнорируются, но учитываются в ограничении)
+        db (AsyncSession): Асинхронная сессия SQLAlchemy для работы с базой данных
+
+    Returns:
+        tuple[list, list]: Список объектов `WalletBalanceResponse` для найденных кошельков
+            и список UUID ненайденных кошельков (в порядке запроса)
+
+    Exceptions:
+        HTTPException: В случае превышения LOOKUP_MAX_BATCH_SIZE или ошибки при получении балансов
+        SQLAlchemyError: В случае ошибки базы данных
+        Exception: В случае неожиданной ошибки
+    """
+    # Ограничение проверяется по исходному списку, чтобы повторы не обходили его
+    if len(wallet_uuids) > LOOKUP_MAX_BATCH_SIZE:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Too many wallet UUIDs in lookup request (max {LOOKUP_MAX_BATCH_SIZE})"
+        )
+    requested = list(dict.fromkeys(wallet_uuids))
+    if not requested:
+        return [], []
+
+    try:
+        # В базе ищутся только UUID, которые могут существовать по фильтру
+        candidates = [wallet_uuid for wallet_uuid in requested if WALLET_FILTER.might_contain(wallet_uuid)]
+        balances = {}
+        for shard_id, shard_uuids in group_by_shard(db, candidates).items():
+            if not shard_uuids:
+                continue
+            uuids = bindparam("uuids", value=shard_uuids, type_=ARRAY(UUID(as_uuid=True)))
+            stmt = select(Wallet.wallet_uuid, Wallet.balance).where(Wallet.wallet_uuid == any_(uuids))
+            bind_arguments = {"shard_id": shard_id} if shard_id is not None else None
+            result = await db.execute(stmt, bind_arguments=bind_arguments)
+            balances.update((row.wallet_uuid, row.balance) for row in result)
+
+        wallets = [
+            WalletBalanceResponse(wallet_uuid=wallet_uuid, balance=balances[wallet_uuid])
+            for wallet_uuid in requested if wallet_uuid in balances
+        ]
+        missing = [wallet_uuid for wallet_uuid in requested if wallet_uuid not in balances]
+        return wallets, missing
+    except SQLAlchemyError:
+        raise HTTPException(status_code=500, detail="Database error during wallets lookup")
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Unexpected error: {str(e)}")
+
+
 async def create_new_wallet(db: AsyncSession) -> dict:
     """
     Создает новый кошелек с начальным балансом 0.00
@@ -149,6 +357,7 @@ async def create_new_wallet(db: AsyncSession) -> dict:
         db.add(wallet)
         await db.commit()
         await db.refresh(wallet)
+        WALLET_FILTER.add(wallet_uuid)
 
         return {
             "wallet_uuid": wallet.wallet_uuid,
@@ -187,10 +396,30 @@ async def get_list_wallets(db: AsyncSession) -> list:
         raise HTTPException(status_code=500, detail=f"Unexpected error: {str(e)}")
 
 
+async def _delete_wallet(wallet_uuid: uuid.UUID, db: AsyncSession, remaining_ms: int | None = None) -> dict:
+    """
+    Одна попытка транзакции удаления кошелька: блокировка строки, удаление и коммит.
+    """
+    await set_write_timeouts(db, wallet_uuid, remaining_ms)
+    # Ищем кошелек по UUID
+    wallet = await get_wallet_by_uuid(wallet_uuid, db, for_update=True)
+    if not wallet:
+        return {"message": "Wallet not found", "wallet_uuid": wallet_uuid}
+
+    await db.delete(wallet)
+    await db.commit()
+    WALLET_FILTER.remove(wallet_uuid)
+
+    return {"message": "Wallet successfully deleted", "wallet_uuid": wallet_uuid}
+
+
 async def delete_wallet_by_uuid(wallet_uuid: uuid.UUID, db: AsyncSession) -> dict:
     """
     Удаляет кошелек по UUID из базы данных.
 
+    Транзакция выполняется с lock_timeout и statement_timeout и повторяется с джиттером
+    при таймауте блокировки, дедлоке или ошибке сериализации (см. `run_with_retry`).
+
     Args:
         wallet_uuid (uuid.UUID): UUID кошелька для удаления
         db (AsyncSession): Асинхронная сессия SQLAlchemy для работы с базой данных
@@ -199,21 +428,19 @@ async def delete_wallet_by_uuid(wallet_uuid: uuid.UUID, db: AsyncSession) -> dic
         dict: Информацию о завершении операции (например, сообщение об успешном удалении)
 
     Exceptions:
-        HTTPException: В случае ошибки при удалении кошелька
+        HTTPException: В случае ошибки при удалении кошелька или если кошелек занят
         SQLAlchemyError: В случае ошибки базы данных
         Exception: В случае неожиданной ошибки
     """
-    try:
-        # Ищем кошелек по UUID
-        wallet = await get_wallet_by_uuid(wallet_uuid, db)
-        if not wallet:
-            return {"message": "Wallet not found", "wallet_uuid": wallet_uuid}
+    if not WALLET_FILTER.might_contain(wallet_uuid):
+        return {"message": "Wallet not found", "wallet_uuid": wallet_uuid}
 
-        await db.delete(wallet)
-        await db.commit()
-
-        return {"message": "Wallet successfully deleted", "wallet_uuid": wallet_uuid}
+    try:
+        return await run_with_retry(db, lambda remaining_ms: _delete_wallet(wallet_uuid, db, remaining_ms))
 
+    except HTTPException:
+        await db.rollback()
+        raise
     except SQLAlchemyError:
         await db.rollback()
         raise HTTPException(status_code=500, detail="Database error during wallet deletion")
@@ -221,5 +448,3 @@ async def delete_wallet_by_uuid(wallet_uuid: uuid.UUID, db: AsyncSession) -> dic
     except Exception as e:
         await db.rollback()
         raise HTTPException(status_code=500, detail=f"Unexpected error: {str(e)}")
-
-
@@ -2,10 +2,9 @@ import os
 from fastapi import HTTPException
 from loguru import logger
 from sqlalchemy.exc import SQLAlchemyError
-from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
-from sqlalchemy.orm import sessionmaker
 
 from app.database.models import Base
+from app.database.sharding import ShardRouter, parse_shard_urls
 
 
 def get_database_url():
@@ -33,8 +32,32 @@ def get_database_url():
     return f"postgresql+asyncpg://{db_user}:{db_pass}@{db_host}:{db_port}/{db_name}"
 
 
-ENGINE = create_async_engine(get_database_url())
-ASYNC_SESSIONLOCAL = sessionmaker(bind=ENGINE, class_=AsyncSession, expire_on_commit=False)
+def get_shard_urls():
+    """
+    Получает строки подключения к шардам базы данных
+
+    Если задана переменная окружения POSTGRES_SHARDS (`name=url,name=url`), кошельки распределяются
+    между перечисленными базами данных. Иначе используется одна база данных из get_database_url().
+
+    Args:
+        None
+
+    Returns:
+        dict[str, str]: Строки подключения по именам шардов
+
+    Exceptions:
+        ValueError: В случае некорректного описания шардов или неустановленных переменных окружения
+    """
+    shards = os.getenv("POSTGRES_SHARDS")
+    if shards:
+        return parse_shard_urls(shards)
+    return {"default": get_database_url()}
+
+
+SHARD_ROUTER = ShardRouter(get_shard_urls())
+# Движок первого шарда (при одной базе данных - единственный)
+ENGINE = SHARD_ROUTER.engines[SHARD_ROUTER.names[0]]
+ASYNC_SESSIONLOCAL = SHARD_ROUTER.create_sessionmaker(expire_on_commit=False)
 
 
 # logger.info(get_database_url())
@@ -42,7 +65,7 @@ ASYNC_SESSIONLOCAL = sessionmaker(bind=ENGINE, class_=AsyncSession, expire_on_co
 
 async def init_db():
     """
-    Инициализирует базу данных, создавая все таблицы, если они не существуют
+    Инициализирует базы данных всех шардов, создавая все таблицы, если они не существуют
 
     Args:
         None
@@ -55,8 +78,9 @@ async def init_db():
         SQLAlchemyError: В случае ошибки SQLAlchemy
     """
     try:
-        async with ENGINE.begin() as connection:
-            await connection.run_sync(Base.metadata.create_all)
+        for engine in SHARD_ROUTER.engines.values():
+            async with engine.begin() as connection:
+                await connection.run_sync(Base.metadata.create_all)
         logger.info("Database initialized successfully")
     except SQLAlchemyError as e:
         logger.error(f"Database error: {str(e)}")
@@ -70,6 +94,9 @@ async def get_db():
     """
     Генератор сессий базы данных для использования в запросах
 
+    Сессия маршрутизирует запросы по шардам: операции с кошельком выполняются на его шарде,
+    а запросы без указания шарда (например, список кошельков) - на всех шардах.
+
     Args:
         None
 
@@ -110,13 +137,14 @@ async def clear_db():
         Exception: В случае неожиданной ошибки
     """
     try:
-        async with ENGINE.begin() as connection:
-            # Получаем список всех таблиц в базе данных
-            tables = await connection.run_sync(Base.metadata.sorted_tables)
-
-            # Для каждой таблицы выполняем команду TRUNCATE
-            for table in tables:
-                await connection.execute(f"TRUNCATE TABLE {table.name} CASCADE")
+        for engine in SHARD_ROUTER.engines.values():
+            async with engine.begin() as connection:
+                # Получаем список всех таблиц в базе данных
+                tables = await connection.run_sync(Base.metadata.sorted_tables)
+
+                # Для каждой таблицы выполняем команду TRUNCATE
+                for table in tables:
+                    await connection.execute(f"TRUNCATE TABLE {table.name} CASCADE")
 
         logger.info("Database cleared successfully")
     except SQLAlchemyError as e:
@@ -0,0 +1,240 @@
+import argparse
+import asyncio
+import datetime
+import os
+import sys
+import uuid
+from contextlib import suppress
+from typing import AsyncIterator
+
+from loguru import logger
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from .database import ASYNC_SESSIONLOCAL
+from .sharding import get_shard_router
+from ..schemas.export import ExportFormat, ExportTable
+
+# Количество чанков COPY, буферизуемых между базой данных и клиентом
+EXPORT_QUEUE_SIZE = int(os.getenv("WALLETS_EXPORT_QUEUE_SIZE", "16"))
+
+_EXPORT_COLUMNS = {
+    ExportTable.WALLETS: ("wallet_uuid", "balance"),
+    ExportTable.OPERATIONS: ("operation_id", "wallet_uuid", "operation_type", "amount", "timestamp", "transfer_id"),
+}
+
+# Столбец, по которому упорядочивается выгрузка и продолжается с курсора
+_EXPORT_CURSOR_COLUMNS = {
+    ExportTable.WALLETS: "wallet_uuid",
+    ExportTable.OPERATIONS: "operation_id",
+}
+
+
+def _to_naive_utc(value: datetime.datetime) -> datetime.datetime:
+    """Время операций хранится без часового пояса в UTC"""
+    if value.tzinfo is None:
+        return value
+    return value.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+
+
+def build_export_query(table: ExportTable,
+                       wallet_uuids: list[uuid.UUID] | None = None,
+                       since: datetime.datetime | None = None,
+                       until: datetime.datetime | None = None,
+                       after: str | None = None) -> tuple[str, list]:
+    """
+    Формирует запрос выгрузки с фильтрами, которые выполняются на стороне базы данных
+
+    Строки упорядочены по курсорному столбцу (operation_id для операций, wallet_uuid для кошельков),
+    поэтому прерванную выгрузку можно продолжить, передав в after последнее полученное значение.
+
+    Args:
+        table (ExportTable): Выгружаемая таблица
+        wallet_uuids (list[uuid.UUID] | None): Выгружать только указанные кошельки
+        since (datetime.datetime | None): Начало интервала времени операций (включительно)
+        until (datetime.datetime | None): Конец интервала времени операций (не включительно)
+        after (str | None): Курсор - значение курсорного столбца последней полученной строки
+
+    Returns:
+        tuple[str, list]: Текст запроса с параметрами $1, $2, ... и значения параметров
+
+    Exceptions:
+        ValueError: В случае недопустимого курсора или фильтра по времени для кошельков
+    """
+    cursor_column = _EXPORT_CURSOR_COLUMNS[table]
+    conditions = []
+    args = []
+
+    def add_condition(template: str, value):
+        args.append(value)
+        conditions.append(template.format(f"${len(args)}"))
+
+    if after is not None:
+        try:
+            cursor = int(after) if table == ExportTable.OPERATIONS else uuid.UUID(after)
+        except ValueError:
+            raise ValueError(f"Invalid cursor '{after}' for {table.value} export")
+        add_condition(f'"{cursor_column}" > {{}}', cursor)
+
+    if wallet_uuids:
+        add_condition('"wallet_uuid" = ANY({}::uuid[])', list(wallet_uuids))
+
+    if since is not None or until is not None:
+        if table != ExportTable.OPERATIONS:
+            raise ValueError("Time range filter is supported only for operations export")
+        if since is not None:
+            add_condition('"timestamp" >= {}', _to_naive_utc(since))
+        if until is not None:
+            add_condition('"timestamp" < {}', _to_naive_utc(until))
+
+    columns = ", ".join(f'"{column}"' for column in _EXPORT_COLUMNS[table])
+    query = f'SELECT {columns} FROM "{table.value}"'
+    if conditions:
+        query += " WHERE " + " AND ".join(conditions)
+    query += f' ORDER BY "{cursor_column}"'
+    return query, args
+
+
+def resolve_export_shard(db: AsyncSession, shard: str | None) -> str | None:
+    """
+    Определяет шард для выгрузки
+
+    Идентификаторы операций и курсоры выгрузки уникальны только в пределах одной базы данных,
+    поэтому при нескольких шардах выгрузка выполняется по одному шарду.
+
+    Args:
+        db (AsyncSession): Асинхронная сессия SQLAlchemy для работы с базой данных
+        shard (str | None): Имя шарда из запроса
+
+    Returns:
+        str | None: Имя шарда или None, если сессия не шардирована
+
+    Exceptions:
+        ValueError: Если шард не указан при нескольких шардах или не существует
+    """
+    router = get_shard_router(db)
+    if router is None:
+        return None
+    if shard is None:
+        if len(router.names) == 1:
+            return router.names[0]
+        raise ValueError(f"Shard is required for export, available shards: {', '.join(router.names)}")
+    if shard not in router.names:
+        raise ValueError(f"Unknown shard '{shard}', available shards: {', '.join(router.names)}")
+    return shard
+
+
+async def stream_export(db: AsyncSession, query: str, args: list,
+                        export_format: ExportFormat, shard: str | None = None) -> AsyncIterator[bytes]:
+    """
+    Потоково выгружает результат запроса через `COPY (...) TO STDOUT` драйвера asyncpg
+
+    COPY выполняется в отдельной задаче и передает чанки через ограниченную очередь,
+    поэтому потребление памяти не зависит от объема выгрузки, а медленный клиент
+    притормаживает чтение из базы данных.
+
+    Args:
+        db (AsyncSession): Асинхронная сессия SQLAlchemy для работы с базой данных
+        query (str): Запрос выгрузки, см. `build_export_query`
+        args (list): Параметры запроса
+        export_format (ExportFormat): Формат выгрузки (csv или binary)
+        shard (str | None): Шард, см. `resolve_export_shard`
+
+    Returns:
+        AsyncIterator[bytes]: Чанки данных в выбранном формате
+
+    Exceptions:
+        SQLAlchemyError: В случае ошибки базы данных
+    """
+    connection = await db.connection(bind_arguments={"shard_id": shard} if shard is not None else None)
+    raw_connection = (await connection.get_raw_connection()).driver_connection
+
+    queue = asyncio.Queue(maxsize=EXPORT_QUEUE_SIZE)
+    done = object()
+
+    async def put_chunk(chunk):
+        # asyncpg передает bytearray, копируем его, пока чанк ждет в очереди
+        await queue.put(bytes(chunk))
+
+    async def copy():
+        try:
+            await raw_connection.copy_from_query(
+                query, *args,
+                output=put_chunk,
+                format=export_format.value,
+                header=True if export_format == ExportFormat.CSV else None
+            )
+        finally:
+            await queue.put(done)
+
+    task = asyncio.create_task(copy())
+    try:
+        while (chunk := await queue.get()) is not done:
+            yield chunk
+        await task
+    finally:
+        if not task.done():
+            task.cancel()
+            with suppress(asyncio.CancelledError):
+                await task
+
+
+async def export_to_file(output, table: ExportTable, export_format: ExportFormat, shard: str | None = None,
+                         **filters):
+    """
+    Выгружает таблицу в бинарный файловый объект (используется в CLI)
+
+    Args:
+        output: Файловый объект, открытый на запись в бинарном режиме
+        table (ExportTable): Выгружаемая таблица
+        export_format (ExportFormat): Формат выгрузки (csv или binary)
+        shard (str | None): Шард, см. `resolve_export_shard`
+        **filters: Фильтры выгрузки, см. `build_export_query`
+
+    Exceptions:
+        ValueError: В случае недопустимых фильтров или шарда
+    """
+    query, args = build_export_query(table, **filters)
+    async with ASYNC_SESSIONLOCAL() as db:
+        shard = resolve_export_shard(db, shard)
+        async for chunk in stream_export(db, query, args, export_format, shard):
+            output.write(chunk)
+        await db.rollback()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Потоковая выгрузка кошельков и операций через COPY TO STDOUT")
+    parser.add_argument("table", choices=[table.value for table in ExportTable])
+    parser.add_argument("--format", dest="export_format", choices=[fmt.value for fmt in ExportFormat],
+                        default=ExportFormat.CSV.value)
+    parser.add_argument("--output", "-o", help="Файл для выгрузки (по умолчанию stdout)")
+    parser.add_argument("--wallet-uuid", dest="wallet_uuids", type=uuid.UUID, action="append",
+                        help="Выгружать только указанный кошелек (можно указать несколько раз)")
+    parser.add_argument("--since", type=datetime.datetime.fromisoformat,
+                        help="Начало интервала времени операций (ISO 8601, включительно)")
+    parser.add_argument("--until", type=datetime.datetime.fromisoformat,
+                        help="Конец интервала времени операций (ISO 8601, не включительно)")
+    parser.add_argument("--after", help="Продолжить выгрузку после указанного значения курсора")
+    parser.add_argument("--shard", help="Шард для выгрузки (обязателен, если шардов несколько)")
+    args = parser.parse_args()
+
+    table = ExportTable(args.table)
+    export_format = ExportFormat(args.export_format)
+    filters = {
+        "wallet_uuids": args.wallet_uuids,
+        "since": args.since,
+        "until": args.until,
+        "after": args.after,
+    }
+    try:
+        if args.output:
+            with open(args.output, "wb") as output:
+                asyncio.run(export_to_file(output, table, export_format, args.shard, **filters))
+        else:
+            asyncio.run(export_to_file(sys.stdout.buffer, table, export_format, args.shard, **filters))
+    except ValueError as e:
+        logger.error(str(e))
+        sys.exit(2)
+
+
+if __name__ == "__main__":
+    main()
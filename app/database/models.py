@@ -64,6 +64,7 @@ class Operation(Base):
         operation_type: Тип операции (пополнение или снятие)
         amount: Сумма операции
         timestamp: Время выполнения операции
+        transfer_id: Идентификатор перевода, связывающий списание и зачисление (None для обычных операций)
 
     Relationships:
         wallet: Кошелек, с которым связана операция
@@ -71,9 +72,11 @@ class Operation(Base):
     __tablename__ = 'operations'
 
     operation_id = Column(Integer, primary_key=True, autoincrement=True)
-    wallet_uuid = Column(UUID(as_uuid=True), ForeignKey('wallets.wallet_uuid', ondelete='CASCADE'), nullable=False)
+    wallet_uuid = Column(UUID(as_uuid=True), ForeignKey('wallets.wallet_uuid', ondelete='CASCADE'), nullable=False,
+                         index=True)
     operation_type = Column(SqlAlchemyEnum(OperationType), nullable=False)
     amount = Column(Numeric(precision=10, scale=2), nullable=False)
     timestamp = Column(DateTime, default=datetime.datetime.utcnow, nullable=False)
+    transfer_id = Column(UUID(as_uuid=True), nullable=True, index=True)
 
     wallet = relationship('Wallet', back_populates='operations', passive_deletes=True)
@@ -0,0 +1,206 @@
+import argparse
+import asyncio
+import os
+import sys
+
+from loguru import logger
+from sqlalchemy import any_, bindparam, delete, func, insert, select
+from sqlalchemy.dialects.postgresql import ARRAY, UUID, insert as pg_insert
+
+from .database import get_shard_urls
+from .models import Operation, Wallet
+from .sharding import ShardRouter
+
+# Количество кошельков, переносимых одной парой транзакций
+REBALANCE_BATCH_SIZE = int(os.getenv("WALLETS_REBALANCE_BATCH_SIZE", "500"))
+
+
+def _uuids_param(wallet_uuids: list):
+    return bindparam("uuids", value=wallet_uuids, type_=ARRAY(UUID(as_uuid=True)))
+
+
+async def find_misplaced_wallets(router: ShardRouter, source: str) -> dict[str, list]:
+    """
+    Находит кошельки шарда, которые по кольцу хеширования принадлежат другому шарду
+
+    UUID кошельков читаются потоково (server-side cursor), в памяти остаются только UUID переносимых кошельков.
+
+    Args:
+        router (ShardRouter): Маршрутизатор с актуальным списком шардов
+        source (str): Имя проверяемого шарда
+
+    Returns:
+        dict[str, list]: UUID переносимых кошельков по именам целевых шардов
+    """
+    misplaced = {}
+    async with router.engines[source].connect() as connection:
+        result = await connection.stream(select(Wallet.wallet_uuid))
+        async for (wallet_uuid,) in result:
+            target = router.shard_for(wallet_uuid)
+            if target != source:
+                misplaced.setdefault(target, []).append(wallet_uuid)
+    return misplaced
+
+
+async def _ledger_state(connection, wallet_uuids: list, for_update: bool = False) -> dict:
+    """
+    Возвращает баланс, количество операций и время последней операции кошельков на шарде
+
+    Args:
+        connection: Соединение с базой данных шарда
+        wallet_uuids (list): UUID кошельков
+        for_update (bool): Заблокировать строки кошельков до конца транзакции
+
+    Returns:
+        dict: Кортежи (баланс, количество операций, время последней операции) по UUID кошельков
+    """
+    uuids = _uuids_param(wallet_uuids)
+    operations = (
+        select(Operation.wallet_uuid, func.count().label("count"), func.max(Operation.timestamp).label("last"))
+        .where(Operation.wallet_uuid == any_(uuids))
+        .group_by(Operation.wallet_uuid)
+        .subquery()
+    )
+    stmt = (
+        select(Wallet.wallet_uuid, Wallet.balance, func.coalesce(operations.c.count, 0), operations.c.last)
+        .outerjoin(operations, operations.c.wallet_uuid == Wallet.wallet_uuid)
+        .where(Wallet.wallet_uuid == any_(uuids))
+    )
+    if for_update:
+        stmt = stmt.with_for_update(of=Wallet)
+    result = await connection.execute(stmt)
+    return {row[0]: tuple(row[1:]) for row in result}
+
+
+async def move_wallets(router: ShardRouter, source: str, target: str, wallet_uuids: list) -> tuple[int, list]:
+    """
+    Переносит кошельки вместе с операциями с одного шарда на другой
+
+    На исходном шарде строки кошельков блокируются (FOR UPDATE) до конца переноса, поэтому операции
+    над ними ждут завершения. Сначала фиксируется транзакция на целевом шарде, затем кошельки удаляются
+    с исходного.
+
+    Если кошелек уже есть на целевом шарде (например, после запуска, прерванного между коммитом на целевом шарде
+    и удалением с исходного), копии сравниваются по балансу, количеству операций и времени последней операции.
+    Исходная копия удаляется, только если копии совпадают. Иначе в одну из копий после прерванного переноса
+    уже записывались операции, кошелек остается на обоих шардах и возвращается как конфликт для разбора оператором:
+    удаление исходной копии потеряло бы ее операции.
+
+    Args:
+        router (ShardRouter): Маршрутизатор с актуальным списком шардов
+        source (str): Имя исходного шарда
+        target (str): Имя целевого шарда
+        wallet_uuids (list): UUID переносимых кошельков
+
+    Returns:
+        tuple[int, list]: Количество кошельков, скопированных на целевой шард, и UUID конфликтующих кошельков
+    """
+    async with router.engines[source].connect() as source_connection, \
+            router.engines[target].connect() as target_connection:
+        async with source_connection.begin():
+            wallets = (await source_connection.execute(
+                select(Wallet.wallet_uuid, Wallet.balance)
+                .where(Wallet.wallet_uuid == any_(_uuids_param(wallet_uuids)))
+                .with_for_update()
+            )).mappings().all()
+            if not wallets:
+                return 0, []
+            locked_uuids = [wallet["wallet_uuid"] for wallet in wallets]
+
+            async with target_connection.begin():
+                inserted = set((await target_connection.execute(
+                    pg_insert(Wallet).values([dict(wallet) for wallet in wallets])
+                    .on_conflict_do_nothing(index_elements=[Wallet.wallet_uuid])
+                    .returning(Wallet.wallet_uuid)
+                )).scalars().all())
+
+                if inserted:
+                    operations = (await source_connection.execute(
+                        select(Operation.wallet_uuid, Operation.operation_type, Operation.amount,
+                               Operation.timestamp, Operation.transfer_id)
+                        .where(Operation.wallet_uuid == any_(_uuids_param(list(inserted))))
+                        .order_by(Operation.operation_id)
+                    )).mappings().all()
+                    if operations:
+                        await target_connection.execute(insert(Operation), [dict(row) for row in operations])
+
+                # Кошельки, уже существующие на целевом шарде, сверяются с исходной копией
+                conflicts = []
+                existing = [wallet_uuid for wallet_uuid in locked_uuids if wallet_uuid not in inserted]
+                if existing:
+                    target_state = await _ledger_state(target_connection, existing, for_update=True)
+                    source_state = await _ledger_state(source_connection, existing)
+                    conflicts = [
+                        wallet_uuid for wallet_uuid in existing
+                        if target_state.get(wallet_uuid) != source_state.get(wallet_uuid)
+                    ]
+
+            moved_uuids = [wallet_uuid for wallet_uuid in locked_uuids if wallet_uuid not in conflicts]
+            if moved_uuids:
+                await source_connection.execute(
+                    delete(Wallet).where(Wallet.wallet_uuid == any_(_uuids_param(moved_uuids)))
+                )
+
+    for wallet_uuid in conflicts:
+        logger.error(
+            f"Wallet {wallet_uuid} differs between shards {source} and {target}: "
+            f"{source_state.get(wallet_uuid)} != {target_state.get(wallet_uuid)}, left on both shards"
+        )
+    return len(inserted), conflicts
+
+
+async def rebalance(router: ShardRouter, batch_size: int = REBALANCE_BATCH_SIZE,
+                    dry_run: bool = False) -> tuple[dict, dict]:
+    """
+    Переносит все кошельки на шарды, которым они принадлежат по кольцу хеширования
+
+    Используется после добавления шардов в POSTGRES_SHARDS: на новые шарды переходит примерно 1/N кошельков.
+
+    Args:
+        router (ShardRouter): Маршрутизатор с актуальным списком шардов
+        batch_size (int): Количество кошельков в одной паре транзакций
+        dry_run (bool): Только подсчитать переносимые кошельки
+
+    Returns:
+        tuple[dict, dict]: Количество переносимых кошельков и UUID конфликтующих кошельков
+            (копии на исходном и целевом шарде различаются, см. `move_wallets`) по парам `источник->цель`
+    """
+    summary, conflicts = {}, {}
+    for source in router.names:
+        misplaced = await find_misplaced_wallets(router, source)
+        for target, wallet_uuids in misplaced.items():
+            pair = f"{source}->{target}"
+            summary[pair] = len(wallet_uuids)
+            logger.info(f"{len(wallet_uuids)} wallets to move from shard {source} to shard {target}")
+            if dry_run:
+                continue
+            for start in range(0, len(wallet_uuids), batch_size):
+                _, batch_conflicts = await move_wallets(router, source, target, wallet_uuids[start:start + batch_size])
+                if batch_conflicts:
+                    conflicts.setdefault(pair, []).extend(batch_conflicts)
+    return summary, conflicts
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Перенос кошельков между шардами после изменения POSTGRES_SHARDS")
+    parser.add_argument("--batch-size", type=int, default=REBALANCE_BATCH_SIZE)
+    parser.add_argument("--dry-run", action="store_true", help="Только показать количество переносимых кошельков")
+    args = parser.parse_args()
+
+    async def run():
+        router = ShardRouter(get_shard_urls())
+        try:
+            summary, conflicts = await rebalance(router, args.batch_size, args.dry_run)
+        finally:
+            await router.dispose()
+        logger.info(f"Rebalance {'plan' if args.dry_run else 'finished'}: {summary or 'nothing to move'}")
+        if conflicts:
+            logger.error(f"Wallets left on both shards, resolve manually: {conflicts}")
+            return 1
+        return 0
+
+    sys.exit(asyncio.run(run()))
+
+
+if __name__ == "__main__":
+    main()
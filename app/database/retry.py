@@ -0,0 +1,224 @@
+import asyncio
+import os
+import random
+import threading
+import time
+import uuid
+from collections import defaultdict, deque
+
+from fastapi import HTTPException
+from loguru import logger
+from sqlalchemy import text
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from .sharding import shard_bind
+
+# Таймауты для пишущих транзакций (в миллисекундах, 0 - без ограничения)
+LOCK_TIMEOUT_MS = int(os.getenv("WALLETS_LOCK_TIMEOUT_MS", "2000"))
+STATEMENT_TIMEOUT_MS = int(os.getenv("WALLETS_STATEMENT_TIMEOUT_MS", "5000"))
+
+# Параметры повторов при конкурентных блокировках
+RETRY_MAX_ATTEMPTS = int(os.getenv("WALLETS_RETRY_MAX_ATTEMPTS", "5"))
+RETRY_BASE_DELAY_MS = int(os.getenv("WALLETS_RETRY_BASE_DELAY_MS", "10"))
+RETRY_MAX_DELAY_MS = int(os.getenv("WALLETS_RETRY_MAX_DELAY_MS", "200"))
+RETRY_DEADLINE_MS = int(os.getenv("WALLETS_RETRY_DEADLINE_MS", "5000"))
+
+# SQLSTATE ошибок, после которых транзакцию можно безопасно повторить
+RETRYABLE_SQLSTATES = {
+    "55P03": "lock_timeout",
+    "40P01": "deadlock",
+    "40001": "serialization_failure",
+}
+
+# SQLSTATE ошибок, после которых транзакция не повторяется, но кошелек считается занятым:
+# statement_timeout срабатывает, когда ожидание блокировок в сумме превысило время на запрос
+GIVE_UP_SQLSTATES = {
+    "57014": "statement_timeout",
+}
+
+
+def _get_sqlstate(exc: BaseException) -> str | None:
+    if not isinstance(exc, DBAPIError):
+        return None
+    return getattr(exc.orig, "sqlstate", None) or getattr(exc.orig, "pgcode", None)
+
+
+def get_retry_reason(exc: BaseException) -> str | None:
+    """
+    Определяет, можно ли повторить транзакцию после ошибки базы данных
+
+    Args:
+        exc (BaseException): Исключение, возникшее при выполнении транзакции
+
+    Returns:
+        str | None: Причина повтора (lock_timeout, deadlock, serialization_failure) или None
+    """
+    return RETRYABLE_SQLSTATES.get(_get_sqlstate(exc))
+
+
+def get_busy_reason(exc: BaseException) -> str | None:
+    """
+    Определяет, вызвана ли ошибка базы данных конкурентным доступом к кошельку
+
+    Args:
+        exc (BaseException): Исключение, возникшее при выполнении транзакции
+
+    Returns:
+        str | None: Причина повтора или отказа (lock_timeout, deadlock, serialization_failure, statement_timeout) или None
+    """
+    sqlstate = _get_sqlstate(exc)
+    return RETRYABLE_SQLSTATES.get(sqlstate) or GIVE_UP_SQLSTATES.get(sqlstate)
+
+
+class RetryStats:
+    """
+    Счетчики повторов транзакций и время ожидания блокировок строк.
+
+    Attributes:
+        retries: Количество повторов по причинам
+        give_ups: Количество отказов после исчерпания попыток или дедлайна по причинам
+        lock_waits: Последние измерения времени ожидания `SELECT ... FOR UPDATE` (в секундах)
+    """
+
+    def __init__(self, max_samples: int = 10000):
+        self._lock = threading.Lock()
+        self.retries = defaultdict(int)
+        self.give_ups = defaultdict(int)
+        self.lock_waits = deque(maxlen=max_samples)
+
+    def record_retry(self, reason: str):
+        with self._lock:
+            self.retries[reason] += 1
+
+    def record_give_up(self, reason: str):
+        with self._lock:
+            self.give_ups[reason] += 1
+
+    def record_lock_wait(self, seconds: float):
+        with self._lock:
+            self.lock_waits.append(seconds)
+
+    def snapshot(self) -> dict:
+        """
+        Возвращает текущие значения счетчиков и перцентили ожидания блокировок в миллисекундах
+        """
+        with self._lock:
+            retries = dict(self.retries)
+            give_ups = dict(self.give_ups)
+            waits = sorted(self.lock_waits)
+
+        def percentile(p: float) -> float | None:
+            if not waits:
+                return None
+            index = min(len(waits) - 1, max(0, round(p / 100 * len(waits)) - 1))
+            return round(waits[index] * 1000, 3)
+
+        return {
+            "retries": retries,
+            "give_ups": give_ups,
+            "lock_wait_ms": {
+                "samples": len(waits),
+                "p50": percentile(50),
+                "p95": percentile(95),
+                "p99": percentile(99),
+                "max": percentile(100),
+            },
+        }
+
+
+RETRY_STATS = RetryStats()
+
+
+def _limit_timeout(configured_ms: int, remaining_ms: int | None) -> int:
+    """Ограничивает таймаут оставшимся временем до дедлайна (0 в настройках - без ограничения)"""
+    if remaining_ms is None:
+        return configured_ms
+    if configured_ms <= 0:
+        return remaining_ms
+    return min(configured_ms, remaining_ms)
+
+
+async def set_write_timeouts(db: AsyncSession, wallet_uuid: uuid.UUID, remaining_ms: int | None = None):
+    """
+    Устанавливает lock_timeout и statement_timeout для текущей транзакции на шарде кошелька
+
+    Оба параметра задаются одним запросом через set_config(..., is_local => true),
+    что эквивалентно SET LOCAL и действует до конца транзакции. Таймауты не превышают
+    оставшееся время до дедлайна повторов, поэтому одна попытка не выходит за общий дедлайн.
+
+    Args:
+        db (AsyncSession): Асинхронная сессия SQLAlchemy для работы с базой данных
+        wallet_uuid (uuid.UUID): UUID кошелька, на шарде которого выполняется транзакция
+        remaining_ms (int | None): Оставшееся время до дедлайна повторов в миллисекундах (None - без дедлайна)
+    """
+    await db.execute(
+        text("SELECT set_config('lock_timeout', :lock_timeout, true), "
+             "set_config('statement_timeout', :statement_timeout, true)"),
+        {
+            "lock_timeout": str(_limit_timeout(LOCK_TIMEOUT_MS, remaining_ms)),
+            "statement_timeout": str(_limit_timeout(STATEMENT_TIMEOUT_MS, remaining_ms)),
+        },
+        bind_arguments=shard_bind(db, wallet_uuid)
+    )
+
+
+def _backoff_delay(attempt: int) -> float:
+    """Экспоненциальная задержка с полным джиттером (в секундах)"""
+    cap = min(RETRY_MAX_DELAY_MS, RETRY_BASE_DELAY_MS * 2 ** attempt)
+    return random.uniform(0, cap) / 1000
+
+
+async def run_with_retry(db: AsyncSession, transaction):
+    """
+    Выполняет пишущую транзакцию, повторяя ее при таймауте блокировки, дедлоке или ошибке сериализации
+
+    Повторы ограничены количеством попыток RETRY_MAX_ATTEMPTS и общим дедлайном RETRY_DEADLINE_MS,
+    между попытками выполняется откат и пауза с джиттером. Каждая попытка получает оставшееся до дедлайна время
+    и передает его в `set_write_timeouts`, поэтому вместе с ожиданием блокировок запрос укладывается в дедлайн.
+    После statement_timeout транзакция не повторяется (время на нее уже исчерпано) и сразу возвращается 503.
+
+    Args:
+        db (AsyncSession): Асинхронная сессия SQLAlchemy для работы с базой данных
+        transaction: Корутинная функция, принимающая оставшееся время до дедлайна в миллисекундах
+            и выполняющая транзакцию и коммит
+
+    Returns:
+        Результат функции transaction
+
+    Exceptions:
+        HTTPException: 503, если транзакцию не удалось выполнить за отведенные попытки или время
+        SQLAlchemyError: В случае ошибки базы данных, после которой повтор невозможен
+    """
+    deadline = time.monotonic() + RETRY_DEADLINE_MS / 1000
+    attempt = 0
+    reason = None
+    while True:
+        remaining_ms = int((deadline - time.monotonic()) * 1000)
+        if remaining_ms < 1:
+            RETRY_STATS.record_give_up(reason or "deadline")
+            logger.warning(f"Giving up wallet transaction after {attempt} attempts: deadline exceeded")
+            raise HTTPException(status_code=503, detail="Wallet is busy, try again later")
+        try:
+            return await transaction(remaining_ms)
+        except DBAPIError as e:
+            reason = get_retry_reason(e)
+            if reason is None:
+                give_up_reason = GIVE_UP_SQLSTATES.get(_get_sqlstate(e))
+                if give_up_reason is None:
+                    raise
+                await db.rollback()
+                RETRY_STATS.record_give_up(give_up_reason)
+                logger.warning(f"Giving up wallet transaction: {give_up_reason}")
+                raise HTTPException(status_code=503, detail="Wallet is busy, try again later")
+            await db.rollback()
+
+            attempt += 1
+            delay = _backoff_delay(attempt)
+            if attempt >= RETRY_MAX_ATTEMPTS or time.monotonic() + delay >= deadline:
+                RETRY_STATS.record_give_up(reason)
+                logger.warning(f"Giving up wallet transaction after {attempt} attempts: {reason}")
+                raise HTTPException(status_code=503, detail="Wallet is busy, try again later")
+
+            RETRY_STATS.record_retry(reason)
+            await asyncio.sleep(delay)
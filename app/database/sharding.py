@@ -0,0 +1,173 @@
+import bisect
+import hashlib
+import os
+import uuid
+
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.ext.horizontal_shard import ShardedSession
+from sqlalchemy.orm import sessionmaker
+
+# Количество виртуальных узлов каждого шарда на кольце консистентного хеширования
+SHARD_VNODES = int(os.getenv("WALLETS_SHARD_VNODES", "128"))
+
+
+def _hash(value: bytes) -> int:
+    return int.from_bytes(hashlib.blake2b(value, digest_size=8).digest(), "big")
+
+
+class HashRing:
+    """
+    Кольцо консистентного хеширования.
+
+    Каждый шард занимает SHARD_VNODES точек на кольце, ключ принадлежит шарду первой точки
+    по часовой стрелке от хеша ключа. При добавлении шарда на него переходит примерно 1/N ключей,
+    остальные ключи остаются на своих шардах.
+
+    Attributes:
+        names: Имена шардов
+    """
+
+    def __init__(self, names: list[str], vnodes: int = SHARD_VNODES):
+        if not names:
+            raise ValueError("At least one shard is required")
+        self.names = list(names)
+        points = sorted(
+            (_hash(f"{name}#{index}".encode()), name) for name in self.names for index in range(vnodes)
+        )
+        self._hashes = [point for point, _ in points]
+        self._owners = [name for _, name in points]
+
+    def get_shard(self, key: uuid.UUID) -> str:
+        """Возвращает имя шарда, которому принадлежит UUID кошелька"""
+        if len(self.names) == 1:
+            return self.names[0]
+        index = bisect.bisect(self._hashes, _hash(key.bytes)) % len(self._hashes)
+        return self._owners[index]
+
+
+def parse_shard_urls(value: str) -> dict[str, str]:
+    """
+    Разбирает список шардов из строки вида `name=url,name=url`
+
+    Args:
+        value (str): Значение переменной окружения POSTGRES_SHARDS
+
+    Returns:
+        dict[str, str]: Строки подключения по именам шардов
+
+    Exceptions:
+        ValueError: В случае некорректного описания шарда или повторяющегося имени
+    """
+    shards = {}
+    for item in filter(None, (item.strip() for item in value.split(","))):
+        name, separator, url = item.partition("=")
+        if not separator or not name.strip() or not url.strip():
+            raise ValueError(f"Invalid shard definition '{item}', expected name=url")
+        if name.strip() in shards:
+            raise ValueError(f"Duplicate shard name '{name.strip()}'")
+        shards[name.strip()] = url.strip()
+    if not shards:
+        raise ValueError("POSTGRES_SHARDS does not contain any shard")
+    return shards
+
+
+class ShardRouter:
+    """
+    Маршрутизатор кошельков по шардам.
+
+    Для каждого шарда создается собственный движок с пулом соединений. Кошелек и все его операции
+    хранятся на шарде, выбранном по UUID кошелька через HashRing.
+
+    Attributes:
+        ring: Кольцо консистентного хеширования
+        engines: Асинхронные движки по именам шардов
+    """
+
+    def __init__(self, urls: dict[str, str], **engine_kwargs):
+        self.ring = HashRing(list(urls))
+        self.engines = {name: create_async_engine(url, **engine_kwargs) for name, url in urls.items()}
+
+    @property
+    def names(self) -> list[str]:
+        return self.ring.names
+
+    def shard_for(self, wallet_uuid: uuid.UUID) -> str:
+        return self.ring.get_shard(wallet_uuid)
+
+    def _shard_chooser(self, mapper, instance, clause=None, **kw):
+        wallet_uuid = getattr(instance, "wallet_uuid", None)
+        if wallet_uuid is None:
+            raise ValueError("Statement cannot be routed to a shard without wallet_uuid")
+        return self.shard_for(wallet_uuid)
+
+    def _identity_chooser(self, mapper, primary_key, *, lazy_loaded_from=None, **kw):
+        if lazy_loaded_from is not None and lazy_loaded_from.identity_token is not None:
+            return [lazy_loaded_from.identity_token]
+        if mapper.primary_key[0].name == "wallet_uuid":
+            return [self.shard_for(primary_key[0])]
+        return self.names
+
+    def _execute_chooser(self, orm_context):
+        lazy_loaded_from = orm_context.lazy_loaded_from
+        if lazy_loaded_from is not None and lazy_loaded_from.identity_token is not None:
+            return [lazy_loaded_from.identity_token]
+        # Запрос без указания шарда выполняется на всех шардах, результаты объединяются
+        return self.names
+
+    def create_sessionmaker(self, **kwargs) -> sessionmaker:
+        """
+        Создает фабрику асинхронных сессий, маршрутизирующих запросы по шардам
+
+        ORM-объекты при сохранении попадают на шард своего кошелька, загруженные объекты
+        остаются привязанными к своему шарду, а запросы без указания шарда выполняются на всех шардах.
+        Маршрутизатор доступен в `session.info["shard_router"]`.
+        """
+        return sessionmaker(
+            class_=AsyncSession,
+            sync_session_class=ShardedSession,
+            shards={name: engine.sync_engine for name, engine in self.engines.items()},
+            shard_chooser=self._shard_chooser,
+            identity_chooser=self._identity_chooser,
+            execute_chooser=self._execute_chooser,
+            info={"shard_router": self},
+            **kwargs
+        )
+
+    async def dispose(self):
+        for engine in self.engines.values():
+            await engine.dispose()
+
+
+def get_shard_router(db: AsyncSession) -> ShardRouter | None:
+    """Возвращает маршрутизатор сессии или None для сессии, работающей с одной базой данных"""
+    return db.info.get("shard_router")
+
+
+def shard_bind(db: AsyncSession, wallet_uuid: uuid.UUID) -> dict | None:
+    """
+    Аргументы привязки запроса к шарду кошелька для `db.execute(..., bind_arguments=...)`
+
+    Args:
+        db (AsyncSession): Асинхронная сессия SQLAlchemy
+        wallet_uuid (uuid.UUID): UUID кошелька
+
+    Returns:
+        dict | None: {"shard_id": ...} или None, если сессия не шардирована
+    """
+    router = get_shard_router(db)
+    if router is None:
+        return None
+    return {"shard_id": router.shard_for(wallet_uuid)}
+
+
+def group_by_shard(db: AsyncSession, wallet_uuids: list[uuid.UUID]) -> dict[str | None, list[uuid.UUID]]:
+    """
+    Группирует UUID кошельков по шардам (для нешардированной сессии - одна группа с ключом None)
+    """
+    router = get_shard_router(db)
+    if router is None:
+        return {None: list(wallet_uuids)}
+    groups = {}
+    for wallet_uuid in wallet_uuids:
+        groups.setdefault(router.shard_for(wallet_uuid), []).append(wallet_uuid)
+    return groups
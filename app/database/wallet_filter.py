@@ -0,0 +1,243 @@
+import asyncio
+import math
+import os
+import time
+import uuid
+
+from loguru import logger
+from sqlalchemy import func, select
+
+from .database import SHARD_ROUTER
+from .models import Wallet
+
+# Фильтр отрицательных ответов включается явно: он хранится в памяти процесса и знает только кошельки,
+# созданные этим процессом после построения, поэтому подходит только для запуска с одним воркером
+WALLET_FILTER_ENABLED = os.getenv("WALLETS_UUID_FILTER_ENABLED", "0").lower() in ("1", "true", "yes")
+WALLET_FILTER_FP_RATE = float(os.getenv("WALLETS_UUID_FILTER_FP_RATE", "0.01"))
+WALLET_FILTER_MIN_CAPACITY = int(os.getenv("WALLETS_UUID_FILTER_MIN_CAPACITY", "100000"))
+# Доля удаленных кошельков (от расчетной емкости), после которой фильтр перестраивается в фоне
+WALLET_FILTER_STALE_RATIO = float(os.getenv("WALLETS_UUID_FILTER_STALE_RATIO", "0.2"))
+# Задержка перед повтором неудачного построения фильтра (в миллисекундах, удваивается до максимума)
+WALLET_FILTER_RETRY_DELAY_MS = int(os.getenv("WALLETS_UUID_FILTER_RETRY_DELAY_MS", "1000"))
+WALLET_FILTER_RETRY_MAX_DELAY_MS = int(os.getenv("WALLETS_UUID_FILTER_RETRY_MAX_DELAY_MS", "60000"))
+
+_MASK64 = (1 << 64) - 1
+
+
+class BloomFilter:
+    """
+    Фильтр Блума для UUID.
+
+    Позиции битов вычисляются двойным хешированием из двух 64-битных половин UUID,
+    поэтому дополнительная хеш-функция не нужна. Ложноотрицательных ответов не бывает,
+    доля ложноположительных не превышает false_positive_rate, пока количество элементов не больше capacity.
+
+    Attributes:
+        capacity: Расчетное количество элементов
+        size: Количество битов
+        hash_count: Количество хеш-функций
+        count: Количество добавленных элементов
+    """
+
+    def __init__(self, capacity: int, false_positive_rate: float):
+        self.capacity = max(1, capacity)
+        self.size = max(8, math.ceil(-self.capacity * math.log(false_positive_rate) / math.log(2) ** 2))
+        self.hash_count = max(1, round(self.size / self.capacity * math.log(2)))
+        self.count = 0
+        self._bits = bytearray((self.size + 7) // 8)
+
+    @property
+    def size_bytes(self) -> int:
+        return len(self._bits)
+
+    def _positions(self, value: uuid.UUID):
+        number = value.int
+        first, second = number & _MASK64, (number >> 64) | 1
+        for index in range(self.hash_count):
+            yield (first + index * second) % self.size
+
+    def add(self, value: uuid.UUID):
+        bits = self._bits
+        for position in self._positions(value):
+            bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, value: uuid.UUID) -> bool:
+        bits = self._bits
+        return all(bits[position >> 3] & (1 << (position & 7)) for position in self._positions(value))
+
+
+class WalletFilter:
+    """
+    Фильтр существующих UUID кошельков для отсечения запросов к несуществующим кошелькам без обращения к базе.
+
+    Пока фильтр не построен, все UUID считаются возможно существующими. Новые кошельки добавляются
+    в фильтр после коммита. Удаленные кошельки из фильтра Блума убрать нельзя - они только увеличивают
+    долю ложноположительных ответов, поэтому при большой доле удалений или переполнении фильтр перестраивается в фоне.
+
+    Attributes:
+        definite_misses: Количество запросов, отсеченных фильтром
+        passes: Количество запросов, пропущенных в базу данных
+        deleted: Количество удаленных кошельков с момента построения
+        last_build: Статистика последнего построения
+    """
+
+    def __init__(self, false_positive_rate: float = WALLET_FILTER_FP_RATE,
+                 min_capacity: int = WALLET_FILTER_MIN_CAPACITY):
+        self.false_positive_rate = false_positive_rate
+        self.min_capacity = min_capacity
+        self._filter = None
+        self._building = None
+        self._rebuild_task = None
+        self._engines = None
+        self.definite_misses = 0
+        self.passes = 0
+        self.deleted = 0
+        self.last_build = None
+
+    @property
+    def ready(self) -> bool:
+        return self._filter is not None
+
+    def might_contain(self, wallet_uuid: uuid.UUID) -> bool:
+        """Возвращает False, только если кошелька с таким UUID точно нет"""
+        if self._filter is None:
+            return True
+        if wallet_uuid in self._filter:
+            self.passes += 1
+            return True
+        self.definite_misses += 1
+        return False
+
+    def add(self, wallet_uuid: uuid.UUID):
+        for bloom in (self._filter, self._building):
+            if bloom is not None:
+                bloom.add(wallet_uuid)
+        if self._filter is not None and self._filter.count > self._filter.capacity:
+            self._schedule_rebuild()
+
+    def remove(self, wallet_uuid: uuid.UUID):
+        if self._filter is None:
+            return
+        self.deleted += 1
+        if self.deleted > self._filter.capacity * WALLET_FILTER_STALE_RATIO:
+            self._schedule_rebuild()
+
+    def load(self, wallet_uuids, capacity: int = None):
+        """Строит фильтр из переданных UUID (без обращения к базе данных)"""
+        wallet_uuids = list(wallet_uuids)
+        bloom = BloomFilter(max(capacity or 0, len(wallet_uuids) * 2, self.min_capacity), self.false_positive_rate)
+        for wallet_uuid in wallet_uuids:
+            bloom.add(wallet_uuid)
+        self._filter, self.deleted = bloom, 0
+
+    def reset(self):
+        """Отключает фильтр: все UUID снова считаются возможно существующими"""
+        if self._rebuild_task is not None:
+            self._rebuild_task.cancel()
+            self._rebuild_task = None
+        self._filter = self._building = None
+        self.definite_misses = self.passes = self.deleted = 0
+
+    async def rebuild(self, engines: list = None):
+        """
+        Строит фильтр по всем кошелькам потоковым чтением UUID со всех шардов
+
+        Кошельки, созданные во время построения, добавляются и в строящийся фильтр.
+
+        Args:
+            engines (list): Асинхронные движки баз данных (по умолчанию - все шарды)
+        """
+        if engines is None:
+            engines = list(SHARD_ROUTER.engines.values())
+        self._engines = engines
+
+        started = time.perf_counter()
+        total = 0
+        for engine in engines:
+            async with engine.connect() as connection:
+                total += await connection.scalar(select(func.count()).select_from(Wallet))
+
+        bloom = BloomFilter(max(total * 2, self.min_capacity), self.false_positive_rate)
+        self._building = bloom
+        try:
+            for engine in engines:
+                async with engine.connect() as connection:
+                    result = await connection.stream(select(Wallet.wallet_uuid).execution_options(yield_per=10000))
+                    async for partition in result.partitions():
+                        for (wallet_uuid,) in partition:
+                            bloom.add(wallet_uuid)
+        finally:
+            self._building = None
+
+        self._filter, self.deleted = bloom, 0
+        seconds = time.perf_counter() - started
+        self.last_build = {
+            "wallets": bloom.count,
+            "seconds": round(seconds, 3),
+            "wallets_per_second": round(bloom.count / seconds) if seconds else None,
+        }
+        logger.info(
+            f"Wallet filter built: {bloom.count} wallets in {seconds:.2f}s, "
+            f"{bloom.size_bytes / 1024 / 1024:.2f} MiB for capacity {bloom.capacity}"
+        )
+
+    async def _rebuild_until_success(self, engines: list = None):
+        delay = WALLET_FILTER_RETRY_DELAY_MS
+        while True:
+            try:
+                await self.rebuild(engines)
+                return
+            except Exception as e:
+                # Пока построение не удалось, работает прежний фильтр (или все запросы идут в базу данных)
+                logger.error(f"Wallet filter build failed, retrying in {delay} ms: {e}")
+                await asyncio.sleep(delay / 1000)
+                delay = min(delay * 2, WALLET_FILTER_RETRY_MAX_DELAY_MS)
+
+    def start(self, engines: list = None) -> asyncio.Task:
+        """
+        Запускает построение фильтра в фоне
+
+        При ошибке (например, шард недоступен) построение повторяется с нарастающей задержкой до успеха.
+
+        Args:
+            engines (list): Асинхронные движки баз данных (по умолчанию - все шарды)
+
+        Returns:
+            asyncio.Task: Задача построения фильтра
+        """
+        if self._rebuild_task is None or self._rebuild_task.done():
+            self._rebuild_task = asyncio.get_running_loop().create_task(self._rebuild_until_success(engines))
+        return self._rebuild_task
+
+    def _schedule_rebuild(self):
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            return
+        self.start(self._engines)
+
+    def snapshot(self) -> dict:
+        """Возвращает состояние фильтра, его размер и статистику отсечения запросов"""
+        bloom = self._filter
+        if bloom is None:
+            return {"enabled": WALLET_FILTER_ENABLED, "ready": False}
+        return {
+            "enabled": WALLET_FILTER_ENABLED,
+            "ready": True,
+            "wallets": bloom.count,
+            "deleted_since_build": self.deleted,
+            "capacity": bloom.capacity,
+            "hash_count": bloom.hash_count,
+            "size_bytes": bloom.size_bytes,
+            "bytes_per_million_capacity": round(bloom.size_bytes / bloom.capacity * 1_000_000),
+            # Фильтр строится с двукратным запасом ёмкости, поэтому на кошелек приходится больше памяти
+            "bytes_per_million_wallets": round(bloom.size_bytes / max(bloom.count, 1) * 1_000_000),
+            "false_positive_rate": self.false_positive_rate,
+            "definite_misses": self.definite_misses,
+            "passes": self.passes,
+            "last_build": self.last_build,
+        }
+
+
+WALLET_FILTER = WalletFilter()
@@ -1,19 +1,33 @@
+import datetime
 import uuid
+from typing import List
+
 import uvicorn
-from fastapi import FastAPI, Depends, HTTPException, status, Request
+from fastapi import FastAPI, Depends, HTTPException, Query, status, Request
 from fastapi.exceptions import RequestValidationError
-from fastapi.responses import JSONResponse
+from fastapi.responses import FileResponse, JSONResponse, PlainTextResponse, StreamingResponse
 from sqlalchemy.exc import SQLAlchemyError
 from sqlalchemy.ext.asyncio import AsyncSession
 
 from .database.crud import create_new_wallet, get_list_wallets, get_wallet_balance, \
-    create_wallet_operation, delete_wallet_by_uuid
+    create_wallet_operation, delete_wallet_by_uuid, get_wallets_balances, create_transfer
 from .database.database import get_db, init_db
+from .database.export import build_export_query, resolve_export_shard, stream_export
+from .database.retry import RETRY_STATS
+from .database.wallet_filter import WALLET_FILTER, WALLET_FILTER_ENABLED
+from .profiling import PROFILE_TOKEN, ProfilingMiddleware, get_profile_path, profile_name, \
+    require_profile_token, sample_event_loop, save_profile
+from .schemas.export import ExportFormat, ExportTable
 from .schemas.operation import OperationRequest
-from .schemas.wallet import WalletListResponse
+from .schemas.transfer import TransferRequest
+from .schemas.wallet import WalletListResponse, WalletLookupRequest, WalletLookupResponse
 
 app = FastAPI(title="wallets")
 
+# Профилирование отдельных запросов подключается только при заданном токене администратора
+if PROFILE_TOKEN:
+    app.add_middleware(ProfilingMiddleware)
+
 app.state.db_initialized = False
 
 
@@ -24,9 +38,13 @@ async def startup_event():
 
     Инициализирует базу данных и устанавливает флаг db_initialized в True,
     чтобы индикатор инициализации базы данных был готов к обработке запросов.
+    Если включен фильтр UUID кошельков, запускает его построение.
     """
     await init_db()
     app.state.db_initialized = True
+    if WALLET_FILTER_ENABLED:
+        # Фильтр строится в фоне с повторами при ошибке, до готовности все запросы идут в базу данных
+        app.state.wallet_filter_build = WALLET_FILTER.start()
 
 
 @app.post("/api/v1/wallets/{wallet_uuid}/operation")
@@ -50,6 +68,22 @@ async def create_operation(wallet_uuid: uuid.UUID, operation: OperationRequest,
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=f"Unknown error {e}")
 
 
+@app.post("/api/v1/transfers")
+async def transfer_funds(transfer: TransferRequest, db: AsyncSession = Depends(get_db)):
+    """
+    Перевод средств между кошельками.
+
+    Списывает сумму с одного кошелька и зачисляет на другой в одной транзакции.
+    Обе записи журнала операций связаны общим transfer_id.
+    """
+    try:
+        return await create_transfer(transfer, db)
+    except HTTPException as e:
+        raise e
+    except Exception as e:
+        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=f"Unknown error: {str(e)}")
+
+
 @app.get("/api/v1/wallets/{wallet_uuid}")
 async def get_balance(wallet_uuid: uuid.UUID, db: AsyncSession = Depends(get_db)):
     """
@@ -86,6 +120,24 @@ async def list_wallets(db: AsyncSession = Depends(get_db)):
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=f"Unknown error: {str(e)}")
 
 
+@app.post("/api/v1/wallets:lookup")
+async def lookup_wallets(lookup: WalletLookupRequest, db: AsyncSession = Depends(get_db)):
+    """
+    Пакетное получение балансов кошельков.
+
+    Возвращает балансы найденных кошельков и список UUID, которые не найдены.
+    """
+    try:
+        wallets, missing = await get_wallets_balances(lookup.wallet_uuids, db)
+        return WalletLookupResponse(wallets=wallets, missing=missing)
+    except SQLAlchemyError:
+        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="Database error")
+    except HTTPException as e:
+        raise e
+    except Exception as e:
+        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=f"Unknown error: {str(e)}")
+
+
 @app.post("/api/v1/wallets/")
 async def create_wallet(db: AsyncSession = Depends(get_db)):
     """
@@ -120,6 +172,89 @@ async def delete_wallet(wallet_uuid: uuid.UUID, db: AsyncSession = Depends(get_d
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=f"Unknown error: {str(e)}")
 
 
+@app.get("/api/v1/metrics/wallet-filter")
+async def wallet_filter_metrics():
+    """
+    Метрики фильтра UUID кошельков.
+
+    Возвращает размер фильтра, время последнего построения и количество запросов, отсеченных без обращения к базе.
+    """
+    return WALLET_FILTER.snapshot()
+
+
+@app.get("/api/v1/export/{table}")
+async def export_ledger(
+        table: ExportTable,
+        export_format: ExportFormat = Query(ExportFormat.CSV, alias="format"),
+        wallet_uuid: List[uuid.UUID] | None = Query(None),
+        since: datetime.datetime | None = None,
+        until: datetime.datetime | None = None,
+        after: str | None = None,
+        shard: str | None = None,
+        db: AsyncSession = Depends(get_db)
+):
+    """
+    Потоковая выгрузка кошельков или журнала операций.
+
+    Данные передаются чанками через `COPY ... TO STDOUT` в формате CSV или бинарном формате COPY.
+    Фильтры по кошелькам и времени выполняются в базе данных, строки упорядочены по курсору
+    (operation_id или wallet_uuid), поэтому прерванную выгрузку можно продолжить параметром after.
+    При нескольких шардах выгрузка выполняется по одному шарду, указанному в параметре shard.
+    """
+    try:
+        query, args = build_export_query(table, wallet_uuids=wallet_uuid, since=since, until=until, after=after)
+        shard = resolve_export_shard(db, shard)
+    except ValueError as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+
+    if export_format == ExportFormat.CSV:
+        media_type, extension = "text/csv", "csv"
+    else:
+        media_type, extension = "application/octet-stream", "bin"
+    return StreamingResponse(
+        stream_export(db, query, args, export_format, shard),
+        media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="{table.value}.{extension}"'}
+    )
+
+
+@app.get("/api/v1/metrics/locks")
+async def lock_metrics():
+    """
+    Метрики конкурентного доступа к кошелькам.
+
+    Возвращает счетчики повторов и отказов пишущих транзакций и перцентили ожидания блокировок строк.
+    """
+    return RETRY_STATS.snapshot()
+
+
+@app.post("/api/v1/admin/profile", dependencies=[Depends(require_profile_token)])
+async def profile_window(seconds: float = Query(10, gt=0, le=60)):
+    """
+    Профилирование воркера в течение заданного окна времени.
+
+    Семплирует стек цикла событий (все запросы воркера) и возвращает профиль в формате collapsed stacks
+    для flamegraph.pl или speedscope. Профиль также сохраняется, имя файла возвращается в заголовке X-Profile-File.
+    """
+    sampler = await sample_event_loop(seconds)
+    name = profile_name("window")
+    save_profile(sampler, name)
+    return PlainTextResponse(sampler.collapsed(), headers={"X-Profile-File": name})
+
+
+@app.get("/api/v1/admin/profiles/{name}", dependencies=[Depends(require_profile_token)])
+async def get_profile(name: str):
+    """
+    Получение сохраненного профиля.
+
+    Возвращает профиль запроса или окна времени по имени файла из заголовка X-Profile-File.
+    """
+    path = get_profile_path(name)
+    if path is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Profile not found")
+    return FileResponse(path, media_type="text/plain")
+
+
 @app.exception_handler(RequestValidationError)
 async def validation_exception_handler(request: Request, exc: RequestValidationError):
     return JSONResponse(
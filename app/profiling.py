@@ -0,0 +1,203 @@
+import asyncio
+import os
+import re
+import secrets
+import sys
+import threading
+import time
+from collections import Counter
+
+from fastapi import Header, HTTPException, status
+from loguru import logger
+
+# Токен администратора для профилирования. Если не задан, профилирование полностью отключено
+PROFILE_TOKEN = os.getenv("WALLETS_PROFILE_TOKEN")
+PROFILE_DIR = os.getenv("WALLETS_PROFILE_DIR", "/tmp/wallets-profiles")
+PROFILE_HEADER = "x-profile-token"
+
+# Интервалы семплирования стека (в секундах)
+REQUEST_SAMPLE_INTERVAL = float(os.getenv("WALLETS_PROFILE_REQUEST_INTERVAL_MS", "1")) / 1000
+WINDOW_SAMPLE_INTERVAL = float(os.getenv("WALLETS_PROFILE_WINDOW_INTERVAL_MS", "5")) / 1000
+
+
+def _frame_name(frame) -> str:
+    code = frame.f_code
+    filename = code.co_filename
+    if "site-packages" in filename:
+        filename = filename.split("site-packages", 1)[1].lstrip("/\\")
+    return f"{code.co_name} ({filename}:{code.co_firstlineno})"
+
+
+def _is_idle(frame) -> bool:
+    """Цикл событий ждет ввода-вывода в selectors.select - такие семплы не относятся к нагрузке на CPU"""
+    return frame.f_code.co_name == "select" and frame.f_code.co_filename.endswith("selectors.py")
+
+
+class StackSampler:
+    """
+    Семплирующий профилировщик стека потока цикла событий.
+
+    Отдельный поток с заданным интервалом снимает стек целевого потока и считает одинаковые стеки.
+    Результат выдается в формате collapsed stacks (`frame;frame;frame count`),
+    который принимают flamegraph.pl, speedscope и inferno.
+
+    Attributes:
+        thread_id: Идентификатор семплируемого потока
+        interval: Интервал семплирования в секундах
+        loop: Цикл событий, в котором выполняется task
+        task: Если задан, учитываются только семплы, когда выполняется эта задача
+        stacks: Счетчик семплов по стекам
+    """
+
+    def __init__(self, thread_id: int, interval: float, loop=None, task=None):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.loop = loop
+        self.task = task
+        self.stacks = Counter()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="stack-sampler", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            self.sample()
+
+    def sample(self):
+        if self.task is not None and asyncio.current_task(self.loop) is not self.task:
+            return
+        frame = sys._current_frames().get(self.thread_id)
+        if frame is None or _is_idle(frame):
+            return
+
+        stack = []
+        while frame is not None:
+            stack.append(_frame_name(frame))
+            frame = frame.f_back
+        self.stacks[";".join(reversed(stack))] += 1
+
+    def collapsed(self) -> str:
+        return "".join(f"{stack} {count}\n" for stack, count in self.stacks.most_common())
+
+
+def save_profile(sampler: StackSampler, name: str, directory: str = None) -> str:
+    """
+    Сохраняет профиль в каталог профилей в формате collapsed stacks
+
+    Args:
+        sampler (StackSampler): Профилировщик с собранными семплами
+        name (str): Имя файла профиля
+        directory (str): Каталог профилей (по умолчанию PROFILE_DIR)
+
+    Returns:
+        str: Путь к сохраненному файлу
+    """
+    directory = directory or PROFILE_DIR
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, name)
+    with open(path, "w") as file:
+        file.write(sampler.collapsed())
+    return path
+
+
+def get_profile_path(name: str) -> str | None:
+    """
+    Возвращает путь к сохраненному профилю или None, если профиль не найден
+
+    Args:
+        name (str): Имя файла профиля (без каталогов)
+    """
+    if os.path.basename(name) != name:
+        return None
+    path = os.path.join(PROFILE_DIR, name)
+    return path if os.path.isfile(path) else None
+
+
+def profile_name(label: str) -> str:
+    """Формирует уникальное имя файла профиля из метки (например, метода и пути запроса)"""
+    label = re.sub(r"[^A-Za-z0-9_.-]+", "_", label).strip("_")
+    return f"{time.strftime('%Y%m%dT%H%M%S')}-{secrets.token_hex(4)}-{label}.collapsed"
+
+
+async def sample_event_loop(seconds: float, interval: float = None) -> StackSampler:
+    """
+    Семплирует поток цикла событий в течение заданного окна времени (все запросы воркера)
+
+    Args:
+        seconds (float): Длительность окна в секундах
+        interval (float): Интервал семплирования в секундах (по умолчанию WINDOW_SAMPLE_INTERVAL)
+
+    Returns:
+        StackSampler: Профилировщик с собранными семплами
+    """
+    sampler = StackSampler(threading.get_ident(), interval or WINDOW_SAMPLE_INTERVAL)
+    sampler.start()
+    try:
+        await asyncio.sleep(seconds)
+    finally:
+        sampler.stop()
+    return sampler
+
+
+def require_profile_token(x_profile_token: str | None = Header(None)):
+    """
+    Зависимость FastAPI для административных эндпоинтов профилирования
+
+    Exceptions:
+        HTTPException: 404, если профилирование отключено, 403, если токен неверный
+    """
+    if not PROFILE_TOKEN:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Not Found")
+    if x_profile_token is None or not secrets.compare_digest(x_profile_token, PROFILE_TOKEN):
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Invalid profile token")
+
+
+class ProfilingMiddleware:
+    """
+    ASGI middleware, профилирующее отдельный запрос с заголовком `X-Profile-Token`.
+
+    Пока запрос выполняется, StackSampler снимает стек потока цикла событий и учитывает только семплы
+    задачи этого запроса. Профиль сохраняется в каталог профилей, имя файла возвращается
+    в заголовке ответа `X-Profile-File`. Подключается только если задан WALLETS_PROFILE_TOKEN,
+    поэтому без токена никаких накладных расходов нет.
+    """
+
+    def __init__(self, app, token: str = None, directory: str = None, interval: float = None):
+        self.app = app
+        self.token = (token or PROFILE_TOKEN).encode()
+        self.directory = directory or PROFILE_DIR
+        self.interval = interval or REQUEST_SAMPLE_INTERVAL
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        token = dict(scope["headers"]).get(PROFILE_HEADER.encode())
+        if token is None or not secrets.compare_digest(token, self.token):
+            return await self.app(scope, receive, send)
+
+        name = profile_name(f"{scope['method']}-{scope['path']}")
+
+        async def send_with_profile_header(message):
+            if message["type"] == "http.response.start":
+                message = dict(message)
+                message["headers"] = list(message.get("headers", [])) + [(b"x-profile-file", name.encode())]
+            await send(message)
+
+        sampler = StackSampler(
+            threading.get_ident(), self.interval,
+            loop=asyncio.get_running_loop(), task=asyncio.current_task()
+        )
+        sampler.start()
+        try:
+            await self.app(scope, receive, send_with_profile_header)
+        finally:
+            sampler.stop()
+            path = save_profile(sampler, name, self.directory)
+            logger.info(f"Request profile saved to {path}")
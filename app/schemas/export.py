@@ -0,0 +1,25 @@
+from enum import Enum
+
+
+class ExportTable(str, Enum):
+    """
+    Перечисление таблиц, доступных для выгрузки.
+
+    Attributes:
+        WALLETS: Кошельки и их балансы.
+        OPERATIONS: Журнал операций над кошельками.
+    """
+    WALLETS = "wallets"
+    OPERATIONS = "operations"
+
+
+class ExportFormat(str, Enum):
+    """
+    Перечисление форматов выгрузки.
+
+    Attributes:
+        CSV: CSV с заголовком.
+        BINARY: Компактный бинарный формат COPY PostgreSQL.
+    """
+    CSV = "csv"
+    BINARY = "binary"
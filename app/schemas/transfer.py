@@ -0,0 +1,22 @@
+import uuid
+from pydantic import BaseModel, condecimal, root_validator
+
+
+class TransferRequest(BaseModel):
+    """
+    Модель запроса перевода между кошельками.
+
+    Attributes:
+        from_wallet_uuid: UUID кошелька, с которого списываются средства.
+        to_wallet_uuid: UUID кошелька, на который зачисляются средства.
+        amount: Сумма перевода (должна быть больше 0, с точностью до 2 знаков после запятой).
+    """
+    from_wallet_uuid: uuid.UUID
+    to_wallet_uuid: uuid.UUID
+    amount: condecimal(gt=0, max_digits=20, decimal_places=2)
+
+    @root_validator(skip_on_failure=True)
+    def check_different_wallets(cls, values):
+        if values["from_wallet_uuid"] == values["to_wallet_uuid"]:
+            raise ValueError("Source and destination wallets must be different")
+        return values
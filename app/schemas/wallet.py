@@ -1,7 +1,11 @@
+import os
 import uuid
-from pydantic import BaseModel
+from pydantic import BaseModel, conlist
 from typing import List
 
+# Максимальное количество UUID в одном запросе пакетного получения балансов
+LOOKUP_MAX_BATCH_SIZE = int(os.getenv("WALLETS_LOOKUP_MAX_BATCH_SIZE", "1000"))
+
 
 class WalletBalanceResponse(BaseModel):
     """
@@ -23,3 +27,26 @@ class WalletListResponse(BaseModel):
         wallets: Список кошельков с их балансами.
     """
     wallets: List[WalletBalanceResponse]
+
+
+class WalletLookupRequest(BaseModel):
+    """
+    Модель запроса пакетного получения балансов кошельков.
+
+    Attributes:
+        wallet_uuids: Список UUID кошельков, балансы которых нужно получить
+            (не больше LOOKUP_MAX_BATCH_SIZE, длина проверяется до разбора элементов).
+    """
+    wallet_uuids: conlist(uuid.UUID, max_items=LOOKUP_MAX_BATCH_SIZE)
+
+
+class WalletLookupResponse(BaseModel):
+    """
+    Модель ответа пакетного получения балансов кошельков.
+
+    Attributes:
+        wallets: Найденные кошельки с их балансами.
+        missing: UUID кошельков, которые не найдены.
+    """
+    wallets: List[WalletBalanceResponse]
+    missing: List[uuid.UUID]
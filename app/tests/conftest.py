@@ -0,0 +1,159 @@
+import asyncio
+import os
+
+import pytest
+import pytest_asyncio
+from httpx import ASGITransport, AsyncClient
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import NullPool
+
+from app.database import retry
+from app.database.database import get_database_url, get_db
+from app.database.models import Base
+from app.database.sharding import ShardRouter, parse_shard_urls
+from app.main import app
+
+# Каждый воркер pytest-xdist работает в своей схеме, поэтому тесты можно запускать параллельно
+TEST_SCHEMA = f"wallets_test_{os.getenv('PYTEST_XDIST_WORKER', 'main')}"
+# Тесты шардирования используют отдельную схему: база одного из шардов может совпадать с основной тестовой базой
+SHARD_TEST_SCHEMA = f"wallets_shard_test_{os.getenv('PYTEST_XDIST_WORKER', 'main')}"
+
+# Таймауты пишущих транзакций в конкурентных тестах (в миллисекундах): при параллельном запуске на загруженной машине
+# ожидание блокировок растет, а тесты проверяют корректность, а не укладывание в боевые таймауты
+CONCURRENT_TEST_TIMEOUT_MS = 60000
+
+# Базы данных для тестов шардирования (`name=url,name=url`, минимум две), например несколько локальных Postgres
+TEST_SHARD_URLS = os.getenv("TEST_POSTGRES_SHARDS")
+
+
+def create_test_engine(url: str = None, schema: str = TEST_SCHEMA, **kwargs):
+    """
+    Создает движок, у которого search_path указывает на схему текущего воркера
+    """
+    return create_async_engine(
+        url or get_database_url(),
+        connect_args={"server_settings": {"search_path": schema}},
+        **kwargs
+    )
+
+
+async def create_test_schema(url: str = None, schema: str = TEST_SCHEMA):
+    engine = create_test_engine(url, schema, poolclass=NullPool)
+    async with engine.begin() as connection:
+        await connection.execute(text(f'DROP SCHEMA IF EXISTS "{schema}" CASCADE'))
+        await connection.execute(text(f'CREATE SCHEMA "{schema}"'))
+        await connection.run_sync(Base.metadata.create_all)
+    await engine.dispose()
+
+
+async def drop_test_schema(url: str = None, schema: str = TEST_SCHEMA):
+    engine = create_test_engine(url, schema, poolclass=NullPool)
+    async with engine.begin() as connection:
+        await connection.execute(text(f'DROP SCHEMA IF EXISTS "{schema}" CASCADE'))
+    await engine.dispose()
+
+
+@pytest.fixture(scope="session")
+def test_schema():
+    """Создает схему воркера с таблицами в начале сессии и удаляет ее в конце."""
+    asyncio.run(create_test_schema())
+    yield TEST_SCHEMA
+    asyncio.run(drop_test_schema())
+
+
+@pytest_asyncio.fixture
+async def client(test_schema):
+    """
+    Клиент, вызывающий приложение в процессе через ASGI.
+
+    Все запросы теста выполняются в одной внешней транзакции, которая откатывается в конце теста.
+    Коммиты в коде приложения фиксируют только точки сохранения (SAVEPOINT).
+    """
+    engine = create_test_engine(poolclass=NullPool)
+    async with engine.connect() as connection:
+        transaction = await connection.begin()
+
+        async def override_get_db():
+            async with AsyncSession(
+                bind=connection,
+                expire_on_commit=False,
+                join_transaction_mode="create_savepoint"
+            ) as session:
+                yield session
+
+        app.dependency_overrides[get_db] = override_get_db
+        try:
+            async with AsyncClient(transport=ASGITransport(app=app), base_url="http://test") as test_client:
+                yield test_client
+        finally:
+            app.dependency_overrides.pop(get_db, None)
+            await transaction.rollback()
+    await engine.dispose()
+
+
+@pytest_asyncio.fixture
+async def concurrent_client(test_schema, monkeypatch):
+    """
+    Клиент для конкурентных тестов: каждый запрос получает свою сессию из пула и реально коммитит.
+
+    Таймауты блокировок, запросов и дедлайн повторов увеличены до CONCURRENT_TEST_TIMEOUT_MS,
+    чтобы результат не зависел от загрузки машины; тест может задать свои значения через monkeypatch.
+    После теста таблицы схемы воркера очищаются. Фикстура также отдает sessionmaker,
+    чтобы тест мог проверить состояние базы напрямую.
+    """
+    for name in ("LOCK_TIMEOUT_MS", "STATEMENT_TIMEOUT_MS", "RETRY_DEADLINE_MS"):
+        monkeypatch.setattr(retry, name, CONCURRENT_TEST_TIMEOUT_MS)
+    engine = create_test_engine(pool_size=20, max_overflow=0)
+    session_local = sessionmaker(bind=engine, class_=AsyncSession, expire_on_commit=False)
+
+    async def override_get_db():
+        async with session_local() as session:
+            yield session
+
+    app.dependency_overrides[get_db] = override_get_db
+    try:
+        async with AsyncClient(transport=ASGITransport(app=app), base_url="http://test") as test_client:
+            yield test_client, session_local
+    finally:
+        app.dependency_overrides.pop(get_db, None)
+        async with engine.begin() as connection:
+            tables = ", ".join(table.name for table in Base.metadata.sorted_tables)
+            await connection.execute(text(f"TRUNCATE TABLE {tables} CASCADE"))
+        await engine.dispose()
+
+
+@pytest.fixture
+def shard_router_factory():
+    """
+    Фабрика маршрутизаторов по базам данных из TEST_POSTGRES_SHARDS.
+
+    В каждой базе создается схема SHARD_TEST_SCHEMA с пустыми таблицами, после теста схемы удаляются.
+    Схема TEST_SCHEMA остальных тестов не затрагивается, даже если база шарда совпадает с основной тестовой базой.
+    Фабрика принимает список имен шардов (по умолчанию все шарды). Без TEST_POSTGRES_SHARDS тест пропускается.
+    """
+    if not TEST_SHARD_URLS:
+        pytest.skip("TEST_POSTGRES_SHARDS is not set")
+    urls = parse_shard_urls(TEST_SHARD_URLS)
+    if len(urls) < 2:
+        pytest.skip("TEST_POSTGRES_SHARDS must contain at least two shards")
+
+    async def create_schemas():
+        for url in urls.values():
+            await create_test_schema(url, SHARD_TEST_SCHEMA)
+
+    async def drop_schemas():
+        for url in urls.values():
+            await drop_test_schema(url, SHARD_TEST_SCHEMA)
+
+    def make_router(names: list[str] = None) -> ShardRouter:
+        return ShardRouter(
+            {name: urls[name] for name in names or urls},
+            poolclass=NullPool,
+            connect_args={"server_settings": {"search_path": SHARD_TEST_SCHEMA}}
+        )
+
+    asyncio.run(create_schemas())
+    yield make_router
+    asyncio.run(drop_schemas())
@@ -1,223 +1,428 @@
+import csv
+import io
 import pytest
 import uuid
-from httpx import AsyncClient
+from fastapi import HTTPException
 
-BASE_URL = "http://localhost:8001"
+from app.database import crud
 
 
 @pytest.mark.asyncio
-async def test_create_wallet():
+async def test_create_wallet(client):
     """Тест на создание нового кошелька."""
-    async with AsyncClient(base_url=BASE_URL) as client:
-        response = await client.post("/api/v1/wallets/")
-        response_json = response.json()
-        assert response.status_code == 200
-        assert "wallet_uuid" in response_json
-        assert "balance" in response_json
-        assert response_json["balance"] == 0.0
-        delete_response = await client.delete(f"/api/v1/wallets/{response_json['wallet_uuid']}")
-        assert delete_response.status_code == 200
+    response = await client.post("/api/v1/wallets/")
+    response_json = response.json()
+    assert response.status_code == 200
+    assert "wallet_uuid" in response_json
+    assert "balance" in response_json
+    assert response_json["balance"] == 0.0
+    delete_response = await client.delete(f"/api/v1/wallets/{response_json['wallet_uuid']}")
+    assert delete_response.status_code == 200
 
 
 @pytest.mark.asyncio
-async def test_get_wallet_balance():
+async def test_get_wallet_balance(client):
     """Тест на получение баланса кошелька по его UUID."""
-    async with AsyncClient(base_url=BASE_URL) as client:
-        response = await client.post("/api/v1/wallets/")
-        create_response_json = response.json()
-        balance_response = await client.get(f"/api/v1/wallets/{create_response_json['wallet_uuid']}")
-        balance_json = balance_response.json()
-        assert balance_response.status_code == 200
-        assert "balance" in balance_json
-        assert balance_json["balance"] == 0.0
+    response = await client.post("/api/v1/wallets/")
+    create_response_json = response.json()
+    balance_response = await client.get(f"/api/v1/wallets/{create_response_json['wallet_uuid']}")
+    balance_json = balance_response.json()
+    assert balance_response.status_code == 200
+    assert "balance" in balance_json
+    assert balance_json["balance"] == 0.0
 
-        delete_response = await client.delete(f"/api/v1/wallets/{create_response_json['wallet_uuid']}")
-        assert delete_response.status_code == 200
+    delete_response = await client.delete(f"/api/v1/wallets/{create_response_json['wallet_uuid']}")
+    assert delete_response.status_code == 200
 
 
 @pytest.mark.asyncio
-async def test_list_wallets():
+async def test_list_wallets(client):
     """Тест на получение списка всех кошельков."""
-    async with AsyncClient(base_url=BASE_URL) as client:
-        response = await client.get("/api/v1/wallets/")
-        response_json = response.json()
+    response = await client.get("/api/v1/wallets/")
+    response_json = response.json()
 
-        assert response.status_code == 200
-        assert isinstance(response_json, dict)
-        assert "wallets" in response_json
-        assert isinstance(response_json["wallets"], list)
+    assert response.status_code == 200
+    assert isinstance(response_json, dict)
+    assert "wallets" in response_json
+    assert isinstance(response_json["wallets"], list)
 
 
 @pytest.mark.asyncio
-async def test_create_operation_deposit():
+async def test_create_operation_deposit(client):
     """Тест на создание операции для кошелька депозит."""
-    async with AsyncClient(base_url=BASE_URL) as client:
-        create_response = await client.post("/api/v1/wallets/")
-        create_response_json = create_response.json()
-        wallet_uuid = create_response_json["wallet_uuid"]
+    create_response = await client.post("/api/v1/wallets/")
+    create_response_json = create_response.json()
+    wallet_uuid = create_response_json["wallet_uuid"]
 
-        operation_data = {
-            "amount": 100.0,
-            "operation_type": "DEPOSIT"
-        }
+    operation_data = {
+        "amount": 100.0,
+        "operation_type": "DEPOSIT"
+    }
 
-        operation_response = await client.post(
-            f"/api/v1/wallets/{wallet_uuid}/operation",
-            json=operation_data
-        )
-        operation_json = operation_response.json()
+    operation_response = await client.post(
+        f"/api/v1/wallets/{wallet_uuid}/operation",
+        json=operation_data
+    )
+    operation_json = operation_response.json()
 
-        assert operation_response.status_code == 200
-        assert operation_json["amount"] == 100.0
-        assert operation_json["operation_type"] == "DEPOSIT"
-        delete_response = await client.delete(f"/api/v1/wallets/{wallet_uuid}")
-        assert delete_response.status_code == 200
+    assert operation_response.status_code == 200
+    assert operation_json["amount"] == 100.0
+    assert operation_json["operation_type"] == "DEPOSIT"
+    delete_response = await client.delete(f"/api/v1/wallets/{wallet_uuid}")
+    assert delete_response.status_code == 200
 
 
 @pytest.mark.asyncio
-async def test_create_operation_withdrow():
+async def test_create_operation_withdrow(client):
     """Тест на создание операции для кошелька снятие."""
-    async with AsyncClient(base_url=BASE_URL) as client:
-        create_response = await client.post("/api/v1/wallets/")
-        create_response_json = create_response.json()
-        wallet_uuid = create_response_json["wallet_uuid"]
-
-        operation_data = {
-            "amount": 100.0,
-            "operation_type": "DEPOSIT"
-        }
-
-        operation_response = await client.post(
-            f"/api/v1/wallets/{wallet_uuid}/operation",
-            json=operation_data
-        )
-        operation_json = operation_response.json()
-
-        assert operation_response.status_code == 200
-        assert operation_json["amount"] == 100.0
-        assert operation_json["operation_type"] == "DEPOSIT"
-
-        operation_data = {
-            "amount": 10.0,
-            "operation_type": "WITHDRAW"
-        }
-
-        operation_response = await client.post(
-            f"/api/v1/wallets/{wallet_uuid}/operation",
-            json=operation_data
-        )
-        operation_json = operation_response.json()
-        assert operation_response.status_code == 200
-        # assert operation_json["balance"] == 90.0
-        assert operation_json["amount"] == 10.0
-        assert operation_json["operation_type"] == "WITHDRAW"
-        delete_response = await client.delete(f"/api/v1/wallets/{wallet_uuid}")
-        assert delete_response.status_code == 200
+    create_response = await client.post("/api/v1/wallets/")
+    create_response_json = create_response.json()
+    wallet_uuid = create_response_json["wallet_uuid"]
+
+    operation_data = {
+        "amount": 100.0,
+        "operation_type": "DEPOSIT"
+    }
+
+    operation_response = await client.post(
+        f"/api/v1/wallets/{wallet_uuid}/operation",
+        json=operation_data
+    )
+    operation_json = operation_response.json()
+
+    assert operation_response.status_code == 200
+    assert operation_json["amount"] == 100.0
+    assert operation_json["operation_type"] == "DEPOSIT"
+
+    operation_data = {
+        "amount": 10.0,
+        "operation_type": "WITHDRAW"
+    }
+
+    operation_response = await client.post(
+        f"/api/v1/wallets/{wallet_uuid}/operation",
+        json=operation_data
+    )
+    operation_json = operation_response.json()
+    assert operation_response.status_code == 200
+    # assert operation_json["balance"] == 90.0
+    assert operation_json["amount"] == 10.0
+    assert operation_json["operation_type"] == "WITHDRAW"
+    delete_response = await client.delete(f"/api/v1/wallets/{wallet_uuid}")
+    assert delete_response.status_code == 200
 
 
 @pytest.mark.asyncio
-async def test_delete_wallet():
+async def test_delete_wallet(client):
     """Тест на удаление кошелька по UUID."""
-    async with AsyncClient(base_url=BASE_URL) as client:
-        create_response = await client.post("/api/v1/wallets/")
-        create_response_json = create_response.json()
-        wallet_uuid = create_response_json["wallet_uuid"]
+    create_response = await client.post("/api/v1/wallets/")
+    create_response_json = create_response.json()
+    wallet_uuid = create_response_json["wallet_uuid"]
 
-        delete_response = await client.delete(f"/api/v1/wallets/{wallet_uuid}")
+    delete_response = await client.delete(f"/api/v1/wallets/{wallet_uuid}")
 
-        assert delete_response.status_code == 200
+    assert delete_response.status_code == 200
 
-        second_delete_response = await client.delete(f"/api/v1/wallets/{wallet_uuid}")
-        assert second_delete_response.status_code == 404
-        assert second_delete_response.json()["detail"] == "Wallet not found"
+    second_delete_response = await client.delete(f"/api/v1/wallets/{wallet_uuid}")
+    assert second_delete_response.status_code == 404
+    assert second_delete_response.json()["detail"] == "Wallet not found"
 
 
 @pytest.mark.asyncio
-async def test_create_wallet():
+async def test_create_wallet(client):
     """Тест на создание нового кошелька."""
-    async with AsyncClient(base_url=BASE_URL) as client:
-        response = await client.post("/api/v1/wallets/")
-        response_json = response.json()
+    response = await client.post("/api/v1/wallets/")
+    response_json = response.json()
 
-        assert response.status_code == 200
-        assert "wallet_uuid" in response_json
-        assert "balance" in response_json
-        assert response_json["balance"] == 0.0
+    assert response.status_code == 200
+    assert "wallet_uuid" in response_json
+    assert "balance" in response_json
+    assert response_json["balance"] == 0.0
 
-        delete_response = await client.delete(f"/api/v1/wallets/{response_json['wallet_uuid']}")
-        assert delete_response.status_code == 200
+    delete_response = await client.delete(f"/api/v1/wallets/{response_json['wallet_uuid']}")
+    assert delete_response.status_code == 200
 
 
 @pytest.mark.asyncio
-async def test_create_wallet_operation_invalid_wallet():
+async def test_create_wallet_operation_invalid_wallet(client):
     """Тест на попытку создания операции для несуществующего кошелька."""
     invalid_wallet_uuid = str(uuid.uuid4())
 
-    async with AsyncClient(base_url=BASE_URL) as client:
-        operation_data = {
-            "amount": 100.0,
-            "operation_type": "DEPOSIT"
-        }
+    operation_data = {
+        "amount": 100.0,
+        "operation_type": "DEPOSIT"
+    }
 
-        response = await client.post(f"/api/v1/wallets/{invalid_wallet_uuid}/operation", json=operation_data)
-        assert response.status_code == 404
-        assert response.json()["detail"] == 'Wallet not found'
+    response = await client.post(f"/api/v1/wallets/{invalid_wallet_uuid}/operation", json=operation_data)
+    assert response.status_code == 404
+    assert response.json()["detail"] == 'Wallet not found'
 
 
 @pytest.mark.asyncio
-async def test_create_wallet_operation_invalid_data():
+async def test_create_wallet_operation_invalid_data(client):
     """Тест на создание операции с некорректными данными."""
-    async with AsyncClient(base_url=BASE_URL) as client:
-        response = await client.post("/api/v1/wallets/")
-        wallet_uuid = response.json()["wallet_uuid"]
+    response = await client.post("/api/v1/wallets/")
+    wallet_uuid = response.json()["wallet_uuid"]
 
-        invalid_operation_data = {
-            "amount": "не число",  # Некорректное значение
-            "operation_type": "UNKNOWN_TYPE"  # Несуществующий тип операции
-        }
+    invalid_operation_data = {
+        "amount": "не число",  # Некорректное значение
+        "operation_type": "UNKNOWN_TYPE"  # Несуществующий тип операции
+    }
 
-        response = await client.post(f"/api/v1/wallets/{wallet_uuid}/operation", json=invalid_operation_data)
-        assert response.status_code == 422  # Ошибка валидации данных
+    response = await client.post(f"/api/v1/wallets/{wallet_uuid}/operation", json=invalid_operation_data)
+    assert response.status_code == 422  # Ошибка валидации данных
 
-        delete_response = await client.delete(f"/api/v1/wallets/{wallet_uuid}")
-        assert delete_response.status_code == 200
+    delete_response = await client.delete(f"/api/v1/wallets/{wallet_uuid}")
+    assert delete_response.status_code == 200
 
 
 @pytest.mark.asyncio
-async def test_get_wallet_balance_invalid_wallet():
+async def test_get_wallet_balance_invalid_wallet(client):
     """Тест на попытку получения баланса несуществующего кошелька."""
     invalid_wallet_uuid = str(uuid.uuid4())
 
-    async with AsyncClient(base_url=BASE_URL) as client:
-        response = await client.get(f"/api/v1/wallets/{invalid_wallet_uuid}")
-        assert response.status_code == 404
-        assert response.json()["detail"] == 'Wallet not found'
+    response = await client.get(f"/api/v1/wallets/{invalid_wallet_uuid}")
+    assert response.status_code == 404
+    assert response.json()["detail"] == 'Wallet not found'
 
 
 @pytest.mark.asyncio
-async def test_delete_wallet_twice():
+async def test_lookup_wallets(client):
+    """Тест на пакетное получение балансов существующих и несуществующих кошельков."""
+    response = await client.post("/api/v1/wallets/")
+    wallet_uuid = response.json()["wallet_uuid"]
+    invalid_wallet_uuid = str(uuid.uuid4())
+
+    lookup_response = await client.post(
+        "/api/v1/wallets:lookup",
+        json={"wallet_uuids": [wallet_uuid, invalid_wallet_uuid, wallet_uuid]}
+    )
+    lookup_json = lookup_response.json()
+
+    assert lookup_response.status_code == 200
+    assert lookup_json["wallets"] == [{"wallet_uuid": wallet_uuid, "balance": 0.0}]
+    assert lookup_json["missing"] == [invalid_wallet_uuid]
+
+    delete_response = await client.delete(f"/api/v1/wallets/{wallet_uuid}")
+    assert delete_response.status_code == 200
+
+
+@pytest.mark.asyncio
+async def test_lookup_wallets_too_many(client):
+    """Тест на превышение максимального размера пакета при получении балансов (в том числе повторами одного UUID)."""
+    wallet_uuids = [str(uuid.uuid4()) for _ in range(crud.LOOKUP_MAX_BATCH_SIZE + 1)]
+
+    response = await client.post("/api/v1/wallets:lookup", json={"wallet_uuids": wallet_uuids})
+    assert response.status_code == 422
+
+    wallet_uuids = [str(uuid.uuid4())] * (crud.LOOKUP_MAX_BATCH_SIZE + 1)
+    response = await client.post("/api/v1/wallets:lookup", json={"wallet_uuids": wallet_uuids})
+    assert response.status_code == 422
+
+    with pytest.raises(HTTPException) as exc_info:
+        await crud.get_wallets_balances([uuid.uuid4()] * (crud.LOOKUP_MAX_BATCH_SIZE + 1), db=None)
+    assert exc_info.value.status_code == 400
+
+
+@pytest.mark.asyncio
+async def test_withdraw_insufficient_funds(client):
+    """Тест на снятие суммы, превышающей баланс кошелька."""
+    response = await client.post("/api/v1/wallets/")
+    wallet_uuid = response.json()["wallet_uuid"]
+
+    operation_data = {
+        "amount": 10.0,
+        "operation_type": "WITHDRAW"
+    }
+
+    response = await client.post(f"/api/v1/wallets/{wallet_uuid}/operation", json=operation_data)
+    assert response.status_code == 400
+    assert response.json()["detail"] == "Insufficient funds"
+
+    delete_response = await client.delete(f"/api/v1/wallets/{wallet_uuid}")
+    assert delete_response.status_code == 200
+
+
+@pytest.mark.asyncio
+async def test_lock_metrics(client):
+    """Тест на получение метрик ожидания блокировок после операции."""
+    response = await client.post("/api/v1/wallets/")
+    wallet_uuid = response.json()["wallet_uuid"]
+
+    operation_data = {
+        "amount": 1.0,
+        "operation_type": "DEPOSIT"
+    }
+    await client.post(f"/api/v1/wallets/{wallet_uuid}/operation", json=operation_data)
+
+    response = await client.get("/api/v1/metrics/locks")
+    response_json = response.json()
+
+    assert response.status_code == 200
+    assert "retries" in response_json
+    assert "give_ups" in response_json
+    assert response_json["lock_wait_ms"]["samples"] > 0
+    assert response_json["lock_wait_ms"]["p50"] is not None
+
+    delete_response = await client.delete(f"/api/v1/wallets/{wallet_uuid}")
+    assert delete_response.status_code == 200
+
+
+@pytest.mark.asyncio
+async def test_delete_wallet_twice(client):
     """Тест на двойное удаление кошелька."""
-    async with AsyncClient(base_url=BASE_URL) as client:
-        response = await client.post("/api/v1/wallets/")
-        wallet_uuid = response.json()["wallet_uuid"]
+    response = await client.post("/api/v1/wallets/")
+    wallet_uuid = response.json()["wallet_uuid"]
 
-        delete_response = await client.delete(f"/api/v1/wallets/{wallet_uuid}")
-        assert delete_response.status_code == 200
+    delete_response = await client.delete(f"/api/v1/wallets/{wallet_uuid}")
+    assert delete_response.status_code == 200
 
-        second_delete_response = await client.delete(f"/api/v1/wallets/{wallet_uuid}")
-        assert second_delete_response.status_code == 404
-        assert second_delete_response.json()["detail"] == "Wallet not found"
+    second_delete_response = await client.delete(f"/api/v1/wallets/{wallet_uuid}")
+    assert second_delete_response.status_code == 404
+    assert second_delete_response.json()["detail"] == "Wallet not found"
 
 
 @pytest.mark.asyncio
-async def test_list_wallets_empty():
+async def test_list_wallets_empty(client):
     """Тест на получение списка кошельков, если их нет."""
-    async with AsyncClient(base_url=BASE_URL) as client:
-        response = await client.get("/api/v1/wallets/")
-        response_json = response.json()
-
-        assert response.status_code == 200
-        assert isinstance(response_json, dict)
-        assert "wallets" in response_json
-        assert isinstance(response_json["wallets"], list)
-        assert len(response_json["wallets"]) == 0  # Проверяем, что кошельков нет
+    response = await client.get("/api/v1/wallets/")
+    response_json = response.json()
+
+    assert response.status_code == 200
+    assert isinstance(response_json, dict)
+    assert "wallets" in response_json
+    assert isinstance(response_json["wallets"], list)
+    assert len(response_json["wallets"]) == 0  # Проверяем, что кошельков нет
+
+
+@pytest.mark.asyncio
+async def test_export_operations_csv(client):
+    """Тест на выгрузку операций кошелька в CSV и продолжение выгрузки с курсора."""
+    response = await client.post("/api/v1/wallets/")
+    wallet_uuid = response.json()["wallet_uuid"]
+    other_response = await client.post("/api/v1/wallets/")
+    other_wallet_uuid = other_response.json()["wallet_uuid"]
+
+    for amount in (1.0, 2.0, 3.0):
+        operation_data = {
+            "amount": amount,
+            "operation_type": "DEPOSIT"
+        }
+        await client.post(f"/api/v1/wallets/{wallet_uuid}/operation", json=operation_data)
+        await client.post(f"/api/v1/wallets/{other_wallet_uuid}/operation", json=operation_data)
+
+    response = await client.get("/api/v1/export/operations", params={"wallet_uuid": wallet_uuid})
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/csv")
+    rows = list(csv.DictReader(io.StringIO(response.text)))
+    assert [row["wallet_uuid"] for row in rows] == [wallet_uuid] * 3
+    assert [row["amount"] for row in rows] == ["1.00", "2.00", "3.00"]
+
+    response = await client.get(
+        "/api/v1/export/operations",
+        params={"wallet_uuid": wallet_uuid, "after": rows[0]["operation_id"]}
+    )
+    resumed_rows = list(csv.DictReader(io.StringIO(response.text)))
+    assert resumed_rows == rows[1:]
+
+    response = await client.get(
+        "/api/v1/export/operations",
+        params={"wallet_uuid": wallet_uuid, "since": "2000-01-01T00:00:00", "until": "2000-01-02T00:00:00"}
+    )
+    assert list(csv.DictReader(io.StringIO(response.text))) == []
+
+
+@pytest.mark.asyncio
+async def test_export_wallets_binary(client):
+    """Тест на выгрузку кошельков в бинарном формате COPY."""
+    response = await client.post("/api/v1/wallets/")
+    wallet_uuid = response.json()["wallet_uuid"]
+
+    response = await client.get("/api/v1/export/wallets", params={"format": "binary", "wallet_uuid": wallet_uuid})
+    assert response.status_code == 200
+    assert response.content.startswith(b"PGCOPY\n\xff\r\n\x00")
+    assert uuid.UUID(wallet_uuid).bytes in response.content
+
+
+@pytest.mark.asyncio
+async def test_export_invalid_filters(client):
+    """Тест на выгрузку с недопустимыми фильтрами."""
+    response = await client.get("/api/v1/export/wallets", params={"since": "2000-01-01T00:00:00"})
+    assert response.status_code == 400
+
+    response = await client.get("/api/v1/export/operations", params={"after": "not-a-number"})
+    assert response.status_code == 400
+
+
+@pytest.mark.asyncio
+async def test_transfer(client):
+    """Тест на перевод между кошельками: балансы и две связанные записи журнала."""
+    source_uuid = (await client.post("/api/v1/wallets/")).json()["wallet_uuid"]
+    destination_uuid = (await client.post("/api/v1/wallets/")).json()["wallet_uuid"]
+    await client.post(f"/api/v1/wallets/{source_uuid}/operation", json={"amount": 100.0, "operation_type": "DEPOSIT"})
+
+    transfer_data = {
+        "from_wallet_uuid": source_uuid,
+        "to_wallet_uuid": destination_uuid,
+        "amount": 30.5
+    }
+    response = await client.post("/api/v1/transfers", json=transfer_data)
+    transfer_json = response.json()
+    assert response.status_code == 200
+    assert transfer_json["from_balance"] == "69.50"
+    assert transfer_json["to_balance"] == "30.50"
+
+    response = await client.get(f"/api/v1/wallets/{destination_uuid}")
+    assert response.json()["balance"] == 30.5
+
+    response = await client.get("/api/v1/export/operations", params={"wallet_uuid": [source_uuid, destination_uuid]})
+    rows = [row for row in csv.DictReader(io.StringIO(response.text)) if row["transfer_id"]]
+    assert {(row["wallet_uuid"], row["operation_type"]) for row in rows} == {
+        (source_uuid, "WITHDRAW"),
+        (destination_uuid, "DEPOSIT"),
+    }
+    assert {row["transfer_id"] for row in rows} == {transfer_json["transfer_id"]}
+
+
+@pytest.mark.asyncio
+async def test_transfer_insufficient_funds(client):
+    """Тест на перевод при недостаточном балансе: балансы и журнал не меняются."""
+    source_uuid = (await client.post("/api/v1/wallets/")).json()["wallet_uuid"]
+    destination_uuid = (await client.post("/api/v1/wallets/")).json()["wallet_uuid"]
+    await client.post(f"/api/v1/wallets/{source_uuid}/operation", json={"amount": 10.0, "operation_type": "DEPOSIT"})
+
+    transfer_data = {
+        "from_wallet_uuid": source_uuid,
+        "to_wallet_uuid": destination_uuid,
+        "amount": 10.01
+    }
+    response = await client.post("/api/v1/transfers", json=transfer_data)
+    assert response.status_code == 400
+    assert response.json()["detail"] == "Insufficient funds"
+
+    response = await client.post("/api/v1/wallets:lookup", json={"wallet_uuids": [source_uuid, destination_uuid]})
+    assert [wallet["balance"] for wallet in response.json()["wallets"]] == [10.0, 0.0]
+    response = await client.get("/api/v1/export/operations", params={"wallet_uuid": destination_uuid})
+    assert len(response.text.splitlines()) == 1
+
+
+@pytest.mark.asyncio
+async def test_transfer_invalid_wallets(client):
+    """Тест на перевод с несуществующим кошельком и на тот же кошелек."""
+    wallet_uuid = (await client.post("/api/v1/wallets/")).json()["wallet_uuid"]
+    invalid_wallet_uuid = str(uuid.uuid4())
+
+    response = await client.post("/api/v1/transfers", json={
+        "from_wallet_uuid": wallet_uuid,
+        "to_wallet_uuid": invalid_wallet_uuid,
+        "amount": 1.0
+    })
+    assert response.status_code == 404
+    assert response.json()["detail"] == f"Wallet {invalid_wallet_uuid} not found"
+
+    response = await client.post("/api/v1/transfers", json={
+        "from_wallet_uuid": wallet_uuid,
+        "to_wallet_uuid": wallet_uuid,
+        "amount": 1.0
+    })
+    assert response.status_code == 422
@@ -0,0 +1,194 @@
+import asyncio
+import time
+from decimal import Decimal
+
+import pytest
+from sqlalchemy import case, func, select
+from sqlalchemy.pool import NullPool
+
+from app.database import retry
+from app.database.models import Operation, OperationType, Wallet
+from app.database.retry import RETRY_STATS
+from .conftest import create_test_engine
+
+
+async def get_balance_and_ledger_sum(session_local, wallet_uuid: str) -> tuple[Decimal, Decimal]:
+    """Возвращает баланс кошелька и сумму операций по нему из журнала."""
+    async with session_local() as session:
+        balance = await session.scalar(select(Wallet.balance).where(Wallet.wallet_uuid == wallet_uuid))
+        signed_amount = case(
+            (Operation.operation_type == OperationType.WITHDRAW, -Operation.amount),
+            else_=Operation.amount
+        )
+        ledger_sum = await session.scalar(
+            select(func.coalesce(func.sum(signed_amount), 0)).where(Operation.wallet_uuid == wallet_uuid)
+        )
+        return balance, ledger_sum
+
+
+@pytest.mark.asyncio
+async def test_concurrent_deposits(concurrent_client):
+    """Тест на параллельные пополнения одного кошелька."""
+    client, session_local = concurrent_client
+    response = await client.post("/api/v1/wallets/")
+    wallet_uuid = response.json()["wallet_uuid"]
+
+    operation_data = {
+        "amount": 1.0,
+        "operation_type": "DEPOSIT"
+    }
+    responses = await asyncio.gather(*(
+        client.post(f"/api/v1/wallets/{wallet_uuid}/operation", json=operation_data) for _ in range(100)
+    ))
+    assert all(response.status_code == 200 for response in responses)
+
+    balance, ledger_sum = await get_balance_and_ledger_sum(session_local, wallet_uuid)
+    assert balance == Decimal("100.00")
+    assert balance == ledger_sum
+
+
+@pytest.mark.asyncio
+async def test_concurrent_deposits_and_withdrawals(concurrent_client):
+    """Тест на параллельные пополнения и снятия: баланс совпадает с суммой журнала и не уходит в минус."""
+    client, session_local = concurrent_client
+    response = await client.post("/api/v1/wallets/")
+    wallet_uuid = response.json()["wallet_uuid"]
+
+    operations = [
+        {"amount": 3.0, "operation_type": "DEPOSIT"} if i % 2 else {"amount": 5.0, "operation_type": "WITHDRAW"}
+        for i in range(100)
+    ]
+    responses = await asyncio.gather(*(
+        client.post(f"/api/v1/wallets/{wallet_uuid}/operation", json=operation) for operation in operations
+    ))
+    assert all(response.status_code in (200, 400) for response in responses)
+
+    balance, ledger_sum = await get_balance_and_ledger_sum(session_local, wallet_uuid)
+    assert balance >= 0
+    assert balance == ledger_sum
+
+
+@pytest.mark.asyncio
+async def test_concurrent_opposite_transfers(concurrent_client):
+    """Тест на встречные переводы между двумя кошельками: без дедлоков, сумма балансов сохраняется."""
+    client, session_local = concurrent_client
+    wallet_uuids = []
+    for _ in range(2):
+        response = await client.post("/api/v1/wallets/")
+        wallet_uuid = response.json()["wallet_uuid"]
+        await client.post(f"/api/v1/wallets/{wallet_uuid}/operation", json={"amount": 50.0, "operation_type": "DEPOSIT"})
+        wallet_uuids.append(wallet_uuid)
+
+    deadlocks = RETRY_STATS.snapshot()["retries"].get("deadlock", 0)
+    transfers = [
+        {"from_wallet_uuid": wallet_uuids[i % 2], "to_wallet_uuid": wallet_uuids[1 - i % 2], "amount": 7.0}
+        for i in range(100)
+    ]
+    responses = await asyncio.gather(*(client.post("/api/v1/transfers", json=transfer) for transfer in transfers))
+    assert all(response.status_code in (200, 400) for response in responses)
+    assert sum(response.status_code == 200 for response in responses) > 0
+
+    balances = []
+    for wallet_uuid in wallet_uuids:
+        balance, ledger_sum = await get_balance_and_ledger_sum(session_local, wallet_uuid)
+        assert balance >= 0
+        assert balance == ledger_sum
+        balances.append(balance)
+    assert sum(balances) == Decimal("100.00")
+    assert RETRY_STATS.snapshot()["retries"].get("deadlock", 0) == deadlocks
+
+
+@pytest.mark.asyncio
+async def test_locked_wallet_gives_up_with_503(concurrent_client, monkeypatch):
+    """Тест на повторы при таймаутах блокировки и запроса и отказ 503 для операции и удаления заблокированного кошелька."""
+    client, _ = concurrent_client
+    response = await client.post("/api/v1/wallets/")
+    wallet_uuid = response.json()["wallet_uuid"]
+    monkeypatch.setattr(retry, "LOCK_TIMEOUT_MS", 100)
+
+    engine = create_test_engine(poolclass=NullPool)
+    try:
+        async with engine.connect() as connection:
+            # Вторая транзакция удерживает блокировку строки кошелька
+            async with connection.begin():
+                await connection.execute(
+                    select(Wallet).where(Wallet.wallet_uuid == wallet_uuid).with_for_update()
+                )
+
+                before = RETRY_STATS.snapshot()
+                operation_data = {
+                    "amount": 1.0,
+                    "operation_type": "DEPOSIT"
+                }
+                response = await client.post(f"/api/v1/wallets/{wallet_uuid}/operation", json=operation_data)
+                assert response.status_code == 503
+                assert response.json()["detail"] == "Wallet is busy, try again later"
+
+                after = RETRY_STATS.snapshot()
+                assert after["retries"].get("lock_timeout", 0) - before["retries"].get("lock_timeout", 0) \
+                    == retry.RETRY_MAX_ATTEMPTS - 1
+                assert after["give_ups"].get("lock_timeout", 0) - before["give_ups"].get("lock_timeout", 0) == 1
+
+                # Удаление прекращает повторы по дедлайну, не исчерпав попытки
+                monkeypatch.setattr(retry, "RETRY_MAX_ATTEMPTS", 1000)
+                monkeypatch.setattr(retry, "RETRY_DEADLINE_MS", 500)
+                response = await client.delete(f"/api/v1/wallets/{wallet_uuid}")
+                assert response.status_code == 503
+                assert response.json()["detail"] == "Wallet is busy, try again later"
+
+                final = RETRY_STATS.snapshot()
+                assert final["retries"].get("lock_timeout", 0) > after["retries"].get("lock_timeout", 0)
+                # Последняя попытка ограничена остатком дедлайна, отказ засчитывается по сработавшему таймауту
+                assert sum(final["give_ups"].values()) - sum(after["give_ups"].values()) == 1
+
+                # Без lock_timeout ожидание блокировки прерывает statement_timeout, транзакция не повторяется
+                monkeypatch.setattr(retry, "LOCK_TIMEOUT_MS", 0)
+                monkeypatch.setattr(retry, "STATEMENT_TIMEOUT_MS", 100)
+                response = await client.post(f"/api/v1/wallets/{wallet_uuid}/operation", json=operation_data)
+                assert response.status_code == 503
+                assert RETRY_STATS.snapshot()["give_ups"].get("statement_timeout", 0) \
+                    - final["give_ups"].get("statement_timeout", 0) == 1
+    finally:
+        await engine.dispose()
+
+    response = await client.get(f"/api/v1/wallets/{wallet_uuid}")
+    assert response.json()["balance"] == 0.0
+    response = await client.delete(f"/api/v1/wallets/{wallet_uuid}")
+    assert response.status_code == 200
+
+
+@pytest.mark.asyncio
+async def test_retry_deadline_bounds_request_time(concurrent_client, monkeypatch):
+    """Тест на то, что операция и удаление заблокированного кошелька укладываются в общий дедлайн повторов."""
+    client, _ = concurrent_client
+    response = await client.post("/api/v1/wallets/")
+    wallet_uuid = response.json()["wallet_uuid"]
+    monkeypatch.setattr(retry, "LOCK_TIMEOUT_MS", 400)
+    monkeypatch.setattr(retry, "STATEMENT_TIMEOUT_MS", 5000)
+    monkeypatch.setattr(retry, "RETRY_DEADLINE_MS", 500)
+
+    engine = create_test_engine(poolclass=NullPool)
+    try:
+        async with engine.connect() as connection:
+            async with connection.begin():
+                await connection.execute(
+                    select(Wallet).where(Wallet.wallet_uuid == wallet_uuid).with_for_update()
+                )
+
+                operation_data = {
+                    "amount": 1.0,
+                    "operation_type": "DEPOSIT"
+                }
+                started = time.monotonic()
+                response = await client.post(f"/api/v1/wallets/{wallet_uuid}/operation", json=operation_data)
+                assert response.status_code == 503
+                assert time.monotonic() - started <= 0.5 + 0.15
+
+                # Таймаут блокировки не задан, ожидание ограничивает только дедлайн
+                monkeypatch.setattr(retry, "LOCK_TIMEOUT_MS", 0)
+                started = time.monotonic()
+                response = await client.delete(f"/api/v1/wallets/{wallet_uuid}")
+                assert response.status_code == 503
+                assert time.monotonic() - started <= 0.5 + 0.15
+    finally:
+        await engine.dispose()
@@ -0,0 +1,64 @@
+import threading
+import time
+
+import pytest
+from httpx import ASGITransport, AsyncClient
+
+from app import profiling
+from app.main import app
+
+
+def busy_loop(seconds: float):
+    deadline = time.perf_counter() + seconds
+    while time.perf_counter() < deadline:
+        pass
+
+
+def test_stack_sampler_collects_collapsed_stacks():
+    """Тест на сбор стеков семплирующим профилировщиком."""
+    sampler = profiling.StackSampler(threading.get_ident(), 0.001)
+    sampler.start()
+    busy_loop(0.1)
+    sampler.stop()
+
+    collapsed = sampler.collapsed()
+    assert "busy_loop" in collapsed
+    stack, count = collapsed.splitlines()[0].rsplit(" ", 1)
+    assert int(count) > 0
+    assert "test_stack_sampler_collects_collapsed_stacks" in stack
+
+
+@pytest.mark.asyncio
+async def test_profile_request_with_token(tmp_path):
+    """Тест на профилирование отдельного запроса по заголовку с токеном."""
+    profiled_app = profiling.ProfilingMiddleware(app, token="secret", directory=str(tmp_path))
+    async with AsyncClient(transport=ASGITransport(app=profiled_app), base_url="http://test") as client:
+        response = await client.get("/api/v1/metrics/locks")
+        assert response.status_code == 200
+        assert "x-profile-file" not in response.headers
+
+        response = await client.get("/api/v1/metrics/locks", headers={"X-Profile-Token": "secret"})
+        assert response.status_code == 200
+        assert (tmp_path / response.headers["x-profile-file"]).is_file()
+
+
+@pytest.mark.asyncio
+async def test_profile_admin_endpoints(client, monkeypatch, tmp_path):
+    """Тест на доступ к профилированию окна времени по токену администратора."""
+    response = await client.post("/api/v1/admin/profile", params={"seconds": 0.05})
+    assert response.status_code == 404
+
+    monkeypatch.setattr(profiling, "PROFILE_TOKEN", "secret")
+    monkeypatch.setattr(profiling, "PROFILE_DIR", str(tmp_path))
+    response = await client.post("/api/v1/admin/profile", params={"seconds": 0.05},
+                                 headers={"X-Profile-Token": "wrong"})
+    assert response.status_code == 403
+
+    response = await client.post("/api/v1/admin/profile", params={"seconds": 0.05},
+                                 headers={"X-Profile-Token": "secret"})
+    assert response.status_code == 200
+    name = response.headers["x-profile-file"]
+    assert (tmp_path / name).is_file()
+
+    response = await client.get(f"/api/v1/admin/profiles/{name}", headers={"X-Profile-Token": "secret"})
+    assert response.status_code == 200
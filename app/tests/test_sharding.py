@@ -0,0 +1,252 @@
+import uuid
+from collections import Counter
+
+import pytest
+from httpx import ASGITransport, AsyncClient
+from sqlalchemy import func, insert, select
+
+from app.database.database import get_db
+from app.database.models import Operation, Wallet
+from app.database.rebalance import rebalance
+from app.database.sharding import HashRing, parse_shard_urls
+from app.main import app
+
+
+def test_hash_ring_distribution():
+    """Тест на равномерное распределение кошельков по шардам."""
+    ring = HashRing(["a", "b", "c", "d"])
+    keys = [uuid.uuid4() for _ in range(20000)]
+
+    counts = Counter(ring.get_shard(key) for key in keys)
+    assert set(counts) == {"a", "b", "c", "d"}
+    assert all(3500 < count < 6500 for count in counts.values())
+    assert all(ring.get_shard(key) == HashRing(["d", "c", "b", "a"]).get_shard(key) for key in keys[:100])
+
+
+def test_hash_ring_adding_shard_moves_only_to_new_shard():
+    """Тест на то, что при добавлении шарда кошельки переходят только на новый шард."""
+    keys = [uuid.uuid4() for _ in range(20000)]
+    old_ring = HashRing(["a", "b", "c"])
+    new_ring = HashRing(["a", "b", "c", "d"])
+
+    moved = [key for key in keys if old_ring.get_shard(key) != new_ring.get_shard(key)]
+    assert all(new_ring.get_shard(key) == "d" for key in moved)
+    assert 0.15 < len(moved) / len(keys) < 0.35
+
+
+def test_parse_shard_urls():
+    """Тест на разбор списка шардов из переменной окружения."""
+    assert parse_shard_urls("a=postgresql+asyncpg://u:p@h1/db, b=postgresql+asyncpg://u:p@h2/db") == {
+        "a": "postgresql+asyncpg://u:p@h1/db",
+        "b": "postgresql+asyncpg://u:p@h2/db",
+    }
+    with pytest.raises(ValueError):
+        parse_shard_urls("postgresql+asyncpg://u:p@h1/db")
+    with pytest.raises(ValueError):
+        parse_shard_urls("a=postgresql+asyncpg://u:p@h1/db,a=postgresql+asyncpg://u:p@h2/db")
+
+
+async def get_shard_wallets(router) -> dict[str, dict]:
+    """Возвращает кошельки каждого шарда с балансом и количеством операций."""
+    wallets = {}
+    for name, engine in router.engines.items():
+        async with engine.connect() as connection:
+            operations_count = select(func.count()).where(Operation.wallet_uuid == Wallet.wallet_uuid)
+            result = await connection.execute(
+                select(Wallet.wallet_uuid, Wallet.balance, operations_count.scalar_subquery())
+            )
+            wallets[name] = {str(row[0]): (row[1], row[2]) for row in result}
+    return wallets
+
+
+def sharded_client(router) -> AsyncClient:
+    session_local = router.create_sessionmaker(expire_on_commit=False)
+
+    async def override_get_db():
+        async with session_local() as session:
+            yield session
+
+    app.dependency_overrides[get_db] = override_get_db
+    return AsyncClient(transport=ASGITransport(app=app), base_url="http://test")
+
+
+async def create_wallets_with_deposits(client, count: int) -> list[str]:
+    wallet_uuids = []
+    for index in range(count):
+        response = await client.post("/api/v1/wallets/")
+        wallet_uuid = response.json()["wallet_uuid"]
+        operation_data = {
+            "amount": index + 1,
+            "operation_type": "DEPOSIT"
+        }
+        response = await client.post(f"/api/v1/wallets/{wallet_uuid}/operation", json=operation_data)
+        assert response.status_code == 200
+        wallet_uuids.append(wallet_uuid)
+    return wallet_uuids
+
+
+@pytest.mark.asyncio
+async def test_sharded_wallets(shard_router_factory):
+    """Тест на маршрутизацию кошельков и операций по шардам и объединение списка кошельков."""
+    router = shard_router_factory()
+    try:
+        async with sharded_client(router) as client:
+            wallet_uuids = await create_wallets_with_deposits(client, 20)
+
+            shard_wallets = await get_shard_wallets(router)
+            for wallet_uuid in wallet_uuids:
+                shard = router.shard_for(uuid.UUID(wallet_uuid))
+                assert shard_wallets[shard][wallet_uuid][1] == 1
+            assert sum(len(wallets) for wallets in shard_wallets.values()) == 20
+            assert all(shard_wallets.values())
+
+            response = await client.get("/api/v1/wallets/")
+            assert {wallet["wallet_uuid"] for wallet in response.json()["wallets"]} == set(wallet_uuids)
+
+            response = await client.post("/api/v1/wallets:lookup", json={"wallet_uuids": wallet_uuids})
+            assert [wallet["wallet_uuid"] for wallet in response.json()["wallets"]] == wallet_uuids
+
+            response = await client.get(f"/api/v1/wallets/{wallet_uuids[0]}")
+            assert response.json()["balance"] == 1.0
+
+            response = await client.delete(f"/api/v1/wallets/{wallet_uuids[0]}")
+            assert response.status_code == 200
+            response = await client.get(f"/api/v1/wallets/{wallet_uuids[0]}")
+            assert response.status_code == 404
+    finally:
+        app.dependency_overrides.pop(get_db, None)
+        await router.dispose()
+
+
+@pytest.mark.asyncio
+async def test_rebalance_after_adding_shard(shard_router_factory):
+    """Тест на перенос кошельков с операциями после добавления шардов."""
+    first_router = shard_router_factory()
+    names = first_router.names
+    await first_router.dispose()
+
+    old_router = shard_router_factory(names[:1])
+    try:
+        async with sharded_client(old_router) as client:
+            wallet_uuids = await create_wallets_with_deposits(client, 30)
+    finally:
+        app.dependency_overrides.pop(get_db, None)
+        await old_router.dispose()
+
+    new_router = shard_router_factory(names)
+    try:
+        plan, _ = await rebalance(new_router, dry_run=True)
+        assert set(plan) <= {f"{names[0]}->{name}" for name in names[1:]}
+        assert sum(plan.values()) > 0
+
+        assert await rebalance(new_router, batch_size=4) == (plan, {})
+        assert await rebalance(new_router) == ({}, {})
+
+        shard_wallets = await get_shard_wallets(new_router)
+        for index, wallet_uuid in enumerate(wallet_uuids):
+            balance, operations = shard_wallets[new_router.shard_for(uuid.UUID(wallet_uuid))][wallet_uuid]
+            assert balance == index + 1
+            assert operations == 1
+        assert sum(len(wallets) for wallets in shard_wallets.values()) == 30
+
+        async with sharded_client(new_router) as client:
+            response = await client.post("/api/v1/wallets:lookup", json={"wallet_uuids": wallet_uuids})
+            assert response.json()["missing"] == []
+    finally:
+        app.dependency_overrides.pop(get_db, None)
+        await new_router.dispose()
+
+
+@pytest.mark.asyncio
+async def test_sharded_transfers(shard_router_factory):
+    """Тест на перевод между кошельками одного шарда и отказ в переводе между шардами."""
+    router = shard_router_factory()
+    try:
+        async with sharded_client(router) as client:
+            wallet_uuids = await create_wallets_with_deposits(client, 12)
+            by_shard = {}
+            for wallet_uuid in wallet_uuids:
+                by_shard.setdefault(router.shard_for(uuid.UUID(wallet_uuid)), []).append(wallet_uuid)
+            same_shard = next(wallets for wallets in by_shard.values() if len(wallets) > 1)
+            other_shard = next(wallets for wallets in by_shard.values() if wallets is not same_shard)
+
+            response = await client.post("/api/v1/transfers", json={
+                "from_wallet_uuid": same_shard[0],
+                "to_wallet_uuid": same_shard[1],
+                "amount": 1.0
+            })
+            assert response.status_code == 200
+
+            response = await client.post("/api/v1/transfers", json={
+                "from_wallet_uuid": same_shard[0],
+                "to_wallet_uuid": other_shard[0],
+                "amount": 1.0
+            })
+            assert response.status_code == 400
+
+            shard_wallets = await get_shard_wallets(router)
+            assert sum(balance for wallets in shard_wallets.values() for balance, _ in wallets.values()) == 78
+    finally:
+        app.dependency_overrides.pop(get_db, None)
+        await router.dispose()
+
+
+async def copy_wallet(router, source: str, target: str, wallet_uuid: uuid.UUID):
+    """Копирует кошелек с операциями на другой шард, не удаляя исходную копию (прерванный перенос)."""
+    async with router.engines[source].connect() as source_connection, \
+            router.engines[target].begin() as target_connection:
+        wallet = (await source_connection.execute(
+            select(Wallet.wallet_uuid, Wallet.balance).where(Wallet.wallet_uuid == wallet_uuid)
+        )).mappings().one()
+        operations = (await source_connection.execute(
+            select(Operation.wallet_uuid, Operation.operation_type, Operation.amount, Operation.timestamp)
+            .where(Operation.wallet_uuid == wallet_uuid)
+        )).mappings().all()
+        await target_connection.execute(insert(Wallet).values(**wallet))
+        await target_connection.execute(insert(Operation), [dict(row) for row in operations])
+
+
+@pytest.mark.asyncio
+async def test_rebalance_keeps_diverged_copies(shard_router_factory):
+    """Тест на повторный перенос после прерванного запуска: разошедшиеся копии не удаляются, а возвращаются как конфликт."""
+    first_router = shard_router_factory()
+    names = first_router.names
+    await first_router.dispose()
+
+    old_router = shard_router_factory(names[:1])
+    new_router = shard_router_factory(names)
+    try:
+        async with sharded_client(old_router) as client:
+            wallet_uuids = [uuid.UUID(wallet_uuid) for wallet_uuid in await create_wallets_with_deposits(client, 30)]
+            moving = [wallet_uuid for wallet_uuid in wallet_uuids if new_router.shard_for(wallet_uuid) != names[0]]
+            diverged, unchanged = moving[:2]
+
+            # Перенос прерван после коммита на целевом шарде, затем экземпляр со старым кольцом пишет в исходную копию
+            for wallet_uuid in (diverged, unchanged):
+                await copy_wallet(new_router, names[0], new_router.shard_for(wallet_uuid), wallet_uuid)
+            operation_data = {
+                "amount": 100,
+                "operation_type": "DEPOSIT"
+            }
+            response = await client.post(f"/api/v1/wallets/{diverged}/operation", json=operation_data)
+            assert response.status_code == 200
+        app.dependency_overrides.pop(get_db, None)
+
+        target = new_router.shard_for(diverged)
+        summary, conflicts = await rebalance(new_router)
+        assert sum(summary.values()) == len(moving)
+        assert conflicts == {f"{names[0]}->{target}": [diverged]}
+
+        shard_wallets = await get_shard_wallets(new_router)
+        assert shard_wallets[names[0]][str(diverged)][1] == 2
+        assert shard_wallets[target][str(diverged)][1] == 1
+        assert str(unchanged) not in shard_wallets[names[0]]
+        assert sum(len(wallets) for wallets in shard_wallets.values()) == 31
+
+        summary, conflicts = await rebalance(new_router)
+        assert summary == {f"{names[0]}->{target}": 1}
+        assert conflicts == {f"{names[0]}->{target}": [diverged]}
+    finally:
+        app.dependency_overrides.pop(get_db, None)
+        await old_router.dispose()
+        await new_router.dispose()
@@ -0,0 +1,109 @@
+import uuid
+
+import pytest
+import pytest_asyncio
+from sqlalchemy.pool import NullPool
+
+from app.database import wallet_filter as wallet_filter_module
+from app.database.wallet_filter import WALLET_FILTER, BloomFilter
+from .conftest import create_test_engine
+
+
+@pytest_asyncio.fixture
+async def wallet_filter():
+    """Фильтр UUID кошельков, который сбрасывается после теста."""
+    try:
+        yield WALLET_FILTER
+    finally:
+        WALLET_FILTER.reset()
+
+
+def test_bloom_filter_false_positive_rate():
+    """Тест на отсутствие ложноотрицательных ответов и долю ложноположительных ответов фильтра Блума."""
+    bloom = BloomFilter(10000, 0.01)
+    wallet_uuids = [uuid.uuid4() for _ in range(10000)]
+    for wallet_uuid in wallet_uuids:
+        bloom.add(wallet_uuid)
+
+    assert all(wallet_uuid in bloom for wallet_uuid in wallet_uuids)
+    false_positives = sum(uuid.uuid4() in bloom for _ in range(20000))
+    assert false_positives / 20000 < 0.02
+
+
+@pytest.mark.asyncio
+async def test_wallet_filter_short_circuits_unknown_wallets(client, wallet_filter):
+    """Тест на ответ 404 для несуществующих кошельков по фильтру и обновление фильтра при создании кошелька."""
+    wallet_filter.load([])
+    invalid_wallet_uuid = str(uuid.uuid4())
+
+    response = await client.get(f"/api/v1/wallets/{invalid_wallet_uuid}")
+    assert response.status_code == 404
+    operation_data = {
+        "amount": 1.0,
+        "operation_type": "DEPOSIT"
+    }
+    response = await client.post(f"/api/v1/wallets/{invalid_wallet_uuid}/operation", json=operation_data)
+    assert response.status_code == 404
+    response = await client.delete(f"/api/v1/wallets/{invalid_wallet_uuid}")
+    assert response.status_code == 404
+    assert wallet_filter.definite_misses == 3
+
+    response = await client.post("/api/v1/wallets/")
+    wallet_uuid = response.json()["wallet_uuid"]
+    response = await client.get(f"/api/v1/wallets/{wallet_uuid}")
+    assert response.status_code == 200
+
+    response = await client.post(
+        "/api/v1/wallets:lookup",
+        json={"wallet_uuids": [wallet_uuid, invalid_wallet_uuid]}
+    )
+    assert response.json()["missing"] == [invalid_wallet_uuid]
+
+    response = await client.get("/api/v1/metrics/wallet-filter")
+    assert response.json()["ready"] is True
+    assert response.json()["definite_misses"] == 4
+
+
+@pytest.mark.asyncio
+async def test_wallet_filter_rebuild(concurrent_client, wallet_filter):
+    """Тест на построение фильтра по кошелькам из базы данных."""
+    client, _ = concurrent_client
+    wallet_uuids = []
+    for _ in range(5):
+        response = await client.post("/api/v1/wallets/")
+        wallet_uuids.append(uuid.UUID(response.json()["wallet_uuid"]))
+
+    engine = create_test_engine(poolclass=NullPool)
+    try:
+        await wallet_filter.rebuild([engine])
+    finally:
+        await engine.dispose()
+
+    assert all(wallet_filter.might_contain(wallet_uuid) for wallet_uuid in wallet_uuids)
+    snapshot = wallet_filter.snapshot()
+    assert snapshot["last_build"]["wallets"] == 5
+    assert snapshot["bytes_per_million_wallets"] == round(snapshot["size_bytes"] / 5 * 1_000_000)
+
+
+@pytest.mark.asyncio
+async def test_wallet_filter_start_retries_failed_build(test_schema, wallet_filter, monkeypatch):
+    """Тест на повтор построения фильтра в фоне после ошибки (например, недоступного шарда)."""
+    monkeypatch.setattr(wallet_filter_module, "WALLET_FILTER_RETRY_DELAY_MS", 1)
+    engine = create_test_engine(poolclass=NullPool)
+    attempts = []
+    rebuild = wallet_filter.rebuild
+
+    async def flaky_rebuild(engines=None):
+        attempts.append(engines)
+        if len(attempts) == 1:
+            raise OSError("Connection refused")
+        await rebuild(engines)
+
+    monkeypatch.setattr(wallet_filter, "rebuild", flaky_rebuild)
+    try:
+        await wallet_filter.start([engine])
+    finally:
+        await engine.dispose()
+
+    assert len(attempts) == 2
+    assert wallet_filter.ready
@@ -0,0 +1,55 @@
+import { check } from 'k6';
+import http from 'k6/http';
+
+// Встречные переводы между двумя "горячими" кошельками
+const baseUrl = "http://0.0.0.0:8001/api/v1";
+const initialBalance = 1000000;
+
+export let options = {
+  vus: 200, // количество виртуальных пользователей
+  duration: '1m', // продолжительность теста
+  rps: 2000, // максимальное количество запросов в секунду
+};
+
+const headers = {
+  'Content-Type': 'application/json',
+  'Accept': 'application/json',
+};
+
+// Создание двух кошельков с начальным балансом
+export function setup() {
+  const wallets = [];
+  for (let i = 0; i < 2; i++) {
+    const walletUuid = http.post(`${baseUrl}/wallets/`).json('wallet_uuid');
+    const payload = JSON.stringify({ operation_type: "DEPOSIT", amount: initialBalance });
+    http.post(`${baseUrl}/wallets/${walletUuid}/operation`, payload, { headers });
+    wallets.push(walletUuid);
+  }
+  return { wallets };
+}
+
+export default function (data) {
+  // Четные итерации переводят с первого кошелька на второй, нечетные - в обратную сторону
+  const forward = __ITER % 2 === 0;
+  const payload = JSON.stringify({
+    from_wallet_uuid: forward ? data.wallets[0] : data.wallets[1],
+    to_wallet_uuid: forward ? data.wallets[1] : data.wallets[0],
+    amount: 1,
+  });
+
+  const res = http.post(`${baseUrl}/transfers`, payload, { headers });
+
+  check(res, {
+    'status is 200': (r) => r.status === 200,
+    'response body contains transfer_id': (r) => r.body.includes('transfer_id'),
+  });
+}
+
+// Сумма балансов после теста должна совпадать с начальной
+export function teardown(data) {
+  const res = http.post(`${baseUrl}/wallets:lookup`, JSON.stringify({ wallet_uuids: data.wallets }), { headers });
+  const total = res.json('wallets').reduce((sum, wallet) => sum + wallet.balance, 0);
+  check(total, {
+    'balances are conserved': (t) => t === 2 * initialBalance,
+  });
+}